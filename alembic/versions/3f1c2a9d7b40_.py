@@ -0,0 +1,27 @@
+"""Starsystem content fingerprints.
+
+Revision ID: 3f1c2a9d7b40
+Revises: 2926c3520001
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d7b40'
+down_revision = '2926c3520001'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Fingerprints are calculated while loading starsystem data, so existing rows start out without one.  Force a
+    # refresh to fill them in.
+    op.add_column('starsystem', sa.Column('fingerprint', sa.BigInteger, nullable=True))
+    op.execute("UPDATE status SET starsystem_refreshed=NULL")
+
+
+def downgrade():
+    op.drop_column('starsystem', 'fingerprint')
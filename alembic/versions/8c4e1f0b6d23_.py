@@ -0,0 +1,29 @@
+"""Starsystem source validators, for conditional refreshes.
+
+Revision ID: 8c4e1f0b6d23
+Revises: 3f1c2a9d7b40
+Create Date: 2026-10-16 14:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c4e1f0b6d23'
+down_revision = '3f1c2a9d7b40'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    with op.batch_alter_table('status') as batch:
+        batch.add_column(sa.Column('starsystem_checked', sa.DateTime(timezone=True), nullable=True))
+        batch.add_column(sa.Column('starsystem_validators', postgresql.JSONB, nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('status') as batch:
+        batch.drop_column('starsystem_validators')
+        batch.drop_column('starsystem_checked')
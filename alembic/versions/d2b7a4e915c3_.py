@@ -0,0 +1,30 @@
+"""Trigram index on starsystem names, for !search's optional prefilter.
+
+Revision ID: d2b7a4e915c3
+Revises: 8c4e1f0b6d23
+Create Date: 2026-10-16 16:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2b7a4e915c3'
+down_revision = '8c4e1f0b6d23'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    # The index only serves the optional search_prefilter.  It needs the pg_trgm extension, and creating that takes
+    # superuser rights, so it is only built here if the extension is already there.  (See README.md)
+    if op.get_bind().execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'").scalar():
+        op.create_index(
+            'starsystem__name_trgm', 'starsystem', ['name_lower'],
+            postgresql_using='gin', postgresql_ops={'name_lower': 'gin_trgm_ops'}
+        )
+
+
+def downgrade():
+    # The extension is left in place, since other things may have come to rely on it.
+    op.execute("DROP INDEX IF EXISTS starsystem__name_trgm")
@@ -76,7 +76,7 @@ class CorrectionResult:
         return "<{0.__class__.__name__}(matched={0.matched}, fixed={0.fixed}, input={0.input!r}, corrections={0.corrections!r})>".format(self)
 
 
-@functools.lru_cache(typed=True)
+@functools.lru_cache(maxsize=1024, typed=True)
 def correct(input):
     return CorrectionResult(input)
 
@@ -9,9 +9,19 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md
 """
 import functools
+import hashlib
 import itertools
+import mmap
+import struct
 from binascii import crc32
 
+from ratlib.mappedfile import MappedFile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Note that the hash algorithms presented here are NOT secure for any sort of cryptographic use.  They're optimized
 # for speed first, for this BloomFilter implementation where hash collisions are not critical
 
@@ -63,15 +73,19 @@ fnv1a_256 = _f(256)
 fnv1a_512 = _f(512)
 fnv1a_1024 = _f(1024)
 
-def jenkins_32(data):
+def _jenkins_32_mix(result, data):
     mask = (2**32) - 1
-    result = 0
     for octet in data:
         result += octet
         result &= mask
         result += ((result << 10) & mask)
         result &= mask
         result ^= (result >> 6)
+    return result
+
+def jenkins_32(data):
+    mask = (2**32) - 1
+    result = _jenkins_32_mix(0, data)
     result += ((result << 3) & mask)
     result &= mask
     result ^= (result >> 11)
@@ -80,7 +94,76 @@ def jenkins_32(data):
     return result
 
 
-class BloomFilter:
+class SaltedHash:
+    """
+    Wraps a hash function so that a constant salt is prepended to all of its input.
+
+    Used by BloomFilter.extend_hashes() to derive additional hash functions.  Unlike a lambda, this exposes the
+    underlying function and salt so that alternate engines (like NumpyBloomFilter) can vectorize it.
+    """
+    __slots__ = ('function', 'salt')
+
+    def __init__(self, function, salt):
+        self.function = function
+        self.salt = salt
+
+    def __call__(self, data):
+        return self.function(self.salt + data)
+
+    def __repr__(self):
+        return "<{0.__class__.__name__}({0.function!r}, salt={0.salt!r})>".format(self)
+
+
+class DoubleHashing:
+    """
+    Derives k probe positions from two base hashes, rather than using k separate hash functions.
+
+    This is the Kirsch-Mitzenmacher construction: probe i is at (h1 + i*h2) mod m.  Both base hashes come from a single
+    call to blake2b, which is implemented in C, so the cost of a lookup barely depends on k.
+
+    Instances stand in for the list of hash functions passed to a BloomFilter.  len() returns k.
+    """
+    __slots__ = ('k',)
+
+    def __init__(self, k):
+        self.k = k
+
+    def __len__(self):
+        return self.k
+
+    def __repr__(self):
+        return "<{0.__class__.__name__}(k={0.k})>".format(self)
+
+    @staticmethod
+    def digest(item):
+        """Returns the 16-byte digest used to derive both base hashes of item."""
+        return hashlib.blake2b(item, digest_size=16).digest()
+
+    @staticmethod
+    def base_hashes(digest, bits):
+        """
+        Splits a digest into its two base hashes, reduced modulo 'bits'.
+
+        h2 is never 0, otherwise every probe would land on the same bit.
+        """
+        h1 = int.from_bytes(digest[:8], 'little') % bits
+        h2 = int.from_bytes(digest[8:], 'little') % bits
+        return h1, h2 or 1
+
+    def positions(self, item, bits):
+        """
+        Yields the bit positions for item.
+
+        :param item: Item to hash.  bytes
+        :param bits: Size of the bloom filter in bits.
+        """
+        h1, h2 = self.base_hashes(self.digest(item), bits)
+        for _ in range(self.k):
+            yield h1
+            h1 = (h1 + h2) % bits
+
+
+class BloomFilter(MappedFile):
     """Bloom filter implementation"""
 
 
@@ -96,14 +179,15 @@ class BloomFilter:
         Creates a new BloomFilter that is 'size' bits wide.
 
         :param bits: Size in bits.  ('m')
-        :param functions: List of hash functions.  These should accept bytes input and return an integer.
+        :param functions: List of hash functions.  These should accept bytes input and return an integer.  May also
+            be a DoubleHashing instance.
         :param data: Initial data as a bytes, bytearray or buffer.  Set to all zeroes if omitted.  Note that only the
             first (bits/8) bytes of this structure will be copied.
         """
         self.bits = bits
         if functions is None:
             functions = self.DEFAULT_FUNCTIONS
-        self.functions = tuple(functions)
+        self.functions = functions if isinstance(functions, DoubleHashing) else tuple(functions)
 
         self.data = bytearray(self._round_up(bits, 8) // 8)  # Quick round-up-to-nearest
         self._setbits = 0
@@ -142,8 +226,12 @@ class BloomFilter:
         :param item: Item to be hashed.
         """
         item = self.coerce(item)
-        for function in self.functions:
-            byte, bit = divmod(function(item) % self.bits, 8)
+        if isinstance(self.functions, DoubleHashing):
+            positions = self.functions.positions(item, self.bits)
+        else:
+            positions = (function(item) % self.bits for function in self.functions)
+        for position in positions:
+            byte, bit = divmod(position, 8)
             yield byte, 1 << bit
 
     def add(self, item):
@@ -168,6 +256,28 @@ class BloomFilter:
         for item in it:
             rv += self.add(item)
 
+    def update_many(self, items):
+        """
+        Adds all items from the iterable in one batch.
+
+        This implementation simply calls add() repeatedly; alternate engines may do better.
+        :param items: Iterable of items to add.  bytes or str
+        :return: The number of bits set that weren't previously
+        """
+        rv = 0
+        for item in items:
+            rv += self.add(item)
+        return rv
+
+    def has_many(self, items):
+        """
+        Tests all items from the iterable in one batch.
+
+        :param items: Iterable of items to examine.  bytes or str
+        :return: A list of booleans, one per item, that are True if the corresponding item is in the bloom filter.
+        """
+        return list(self.has(item) for item in items)
+
     def has(self, item):
         """
         Returns True if the item is in the bloom filter.
@@ -238,6 +348,24 @@ class BloomFilter:
                 return last, hashes - 1
             last = bits
 
+    @classmethod
+    def suggest_size_and_hash_set(cls, rate, count, max_hashes=20, rounding=8):
+        """
+        Like suggest_size_and_hashes(), but also chooses which of HASH_SETS to use.
+
+        If no more hashes are needed than there are DEFAULT_FUNCTIONS, those are used as-is ('salted', though no salting
+        actually happens).  Otherwise, double hashing is used: it derives additional probes almost for free, where the
+        salted functions would each rehash the entire item.
+
+        :param rate: Acceptable false positive rate (0..1)
+        :param count: Anticipated number of items
+        :param max_hashes: Maximum number of hashes, None = no limit
+        :param rounding: If non-None, the returned size is rounded up to the nearest multiple of this.
+        :return: bits, hashes, hash_set
+        """
+        bits, hashes = cls.suggest_size_and_hashes(rate, count, max_hashes, rounding)
+        return bits, hashes, ('salted' if hashes <= len(cls.DEFAULT_FUNCTIONS) else 'double')
+
     @classmethod
     def extend_hashes(cls, n, functions=None):
         """
@@ -257,7 +385,7 @@ class BloomFilter:
         for salt in range(n - len(result)):
             function = next(it)
             salt = str(function(str(salt).encode())).encode()
-            result.append(lambda data, _salt=salt, _fn=function: _fn(_salt + data))
+            result.append(SaltedHash(function, salt))
         return result
 
     @property
@@ -269,3 +397,319 @@ class BloomFilter:
     def m(self):
         """m is the standard term used to describe the number of bits in a bloom filter."""
         return self.bits
+
+    # On-disk format: A fixed header followed by the contents of 'data'.
+    #   magic, format version, k, m, entries, set bits, hash set name, timestamp
+    FILE_MAGIC = b'RBLOOM'
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct('<6sHHQQQ16sd')
+    FILE_DESCRIPTION = 'bloom filter'
+
+    def save(self, filename, hash_set, entries=0, timestamp=0.0):
+        """
+        Writes this filter to a file, replacing any existing one.
+
+        :param filename: Path to write to.
+        :param hash_set: Name of the hash set (a key of HASH_SETS) that produced this filter's functions.
+        :param entries: Number of entries in the filter, for informational purposes.
+        :param timestamp: Arbitrary timestamp (as seconds since the epoch) to store with the filter.
+        """
+        if hash_set not in HASH_SETS:
+            raise ValueError("Unknown hash set {!r}".format(hash_set))
+        with self._create(filename, self.k, self.bits, entries, self.setbits, hash_set.encode(), timestamp) as f:
+            f.write(self.data)
+
+    @classmethod
+    def read_header(cls, f):
+        """
+        Reads and validates a filter file header.
+
+        :param f: File-like object, positioned at the start of the file.
+        :return: A dict of header fields.
+        :raises: ValueError if the header is invalid or from an unsupported version.
+        """
+        k, bits, entries, setbits, hash_set, timestamp = cls._read_header(f)
+        hash_set = hash_set.rstrip(b'\0').decode()
+        if hash_set not in HASH_SETS:
+            raise ValueError("Unknown hash set {!r}".format(hash_set))
+        return {
+            'k': k, 'm': bits, 'entries': entries, 'setbits': setbits, 'hash_set': hash_set, 'timestamp': timestamp
+        }
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a filter previously written by save().
+
+        :param filename: Path to read from.
+        :return: A tuple of (filter, header), where header is the dict returned by read_header()
+        :raises: ValueError if the file is invalid.
+        """
+        with open(filename, 'rb') as f:
+            header = cls.read_header(f)
+            bloom = cls(header['m'], HASH_SETS[header['hash_set']](header['k']))
+            data = f.read(len(bloom.data))
+            if len(data) != len(bloom.data):
+                raise ValueError("Truncated bloom filter data")
+        bloom.data = bytearray(data)
+        bloom._setbits = header['setbits']
+        return bloom, header
+
+
+# Named hash function sets that can be stored in filter files.  Each maps to a function that accepts k and returns a
+# list of k hash functions.
+HASH_SETS = {
+    'salted': BloomFilter.extend_hashes,
+    'double': DoubleHashing,
+}
+
+
+# Vectorized counterparts to some of the hash functions above, used by NumpyBloomFilter.  Each entry maps a function
+# to a tuple of (start, step, finish):
+#   start(salt) returns the initial state after consuming salt, as an int.
+#   step(state, octets) returns the new state after consuming one octet from each item.  (uint32 arrays)
+#   finish(state) returns the final hash values.
+# FNV has no finalization step, so its starting state is simply the hash of the salt.
+_U32 = numpy and numpy.uint32
+
+def _fnv1_32_step(state, octets):
+    return (state * _U32(fnv_primes[32])) ^ octets
+
+def _fnv1a_32_step(state, octets):
+    return (state ^ octets) * _U32(fnv_primes[32])
+
+def _jenkins_32_step(state, octets):
+    state = state + octets
+    state = state + (state << _U32(10))
+    return state ^ (state >> _U32(6))
+
+def _jenkins_32_finish(state):
+    state = state + (state << _U32(3))
+    state = state ^ (state >> _U32(11))
+    return state + (state << _U32(11))
+
+_VECTORIZED_HASHES = {
+    fnv1_32: (fnv1_32, _fnv1_32_step, None),
+    fnv1a_32: (fnv1a_32, _fnv1a_32_step, None),
+    jenkins_32: (functools.partial(_jenkins_32_mix, 0), _jenkins_32_step, _jenkins_32_finish),
+}
+
+
+class NumpyBloomFilter(BloomFilter):
+    """
+    Bloom filter implementation backed by a NumPy array.
+
+    The bit layout of 'data' is identical to BloomFilter, so the two can be used interchangeably.  update_many() and
+    has_many() hash entire batches of items at once, which is substantially faster than adding or testing items one at
+    a time when the hash functions are among the ones in _VECTORIZED_HASHES (or SaltedHash wrappers of them).  Other
+    hash functions still work, but are evaluated one item at a time.
+    """
+    available = numpy is not None
+    BATCH_SIZE = 65536  # Maximum number of items hashed at once by update_many()/has_many()
+
+    def __init__(self, bits, functions=None, data=None):
+        """
+        Creates a new NumpyBloomFilter that is 'size' bits wide.
+
+        :param bits: Size in bits.  ('m')
+        :param functions: List of hash functions.  These should accept bytes input and return an integer.  May also
+            be a DoubleHashing instance.
+        :param data: Initial data as a bytes, bytearray or buffer.  Set to all zeroes if omitted.  Note that only the
+            first (bits/8) bytes of this structure will be copied.
+        """
+        if not self.available:
+            raise RuntimeError("NumpyBloomFilter requires numpy.")
+        self.bits = bits
+        if functions is None:
+            functions = self.DEFAULT_FUNCTIONS
+        self.functions = functions if isinstance(functions, DoubleHashing) else tuple(functions)
+
+        self.data = numpy.zeros(self._round_up(bits, 8) // 8, dtype=numpy.uint8)
+        self._setbits = 0
+        if data is not None:
+            self.read(data)
+
+    def read(self, data):
+        """
+        Copies data into self and updates the number of set bits.
+        """
+        data = numpy.frombuffer(data, dtype=numpy.uint8)[:len(self.data)]
+        self.data[:len(data)] = data
+        self.count_bits()
+
+    def count_bits(self):
+        bits = int(numpy.asarray(self.NBITS, dtype=numpy.uint8)[self.data].sum(dtype=numpy.int64))
+        self._setbits = bits
+        return bits
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a filter previously written by save(), memory-mapping its data rather than copying it.
+
+        The mapping is copy-on-write: the filter can still be modified, but changes are never written back to the file.
+
+        :param filename: Path to read from.
+        :return: A tuple of (filter, header), where header is the dict returned by read_header()
+        :raises: ValueError if the file is invalid.
+        """
+        with open(filename, 'rb') as f:
+            header = cls.read_header(f)
+            bloom = cls(header['m'], HASH_SETS[header['hash_set']](header['k']))
+            buffer = cls._map(f, cls.FILE_HEADER.size + len(bloom.data), access=mmap.ACCESS_COPY)
+        bloom.data = numpy.frombuffer(buffer, dtype=numpy.uint8, count=len(bloom.data), offset=cls.FILE_HEADER.size)
+        bloom._setbits = header['setbits']
+        return bloom, header
+
+    @staticmethod
+    def _pack(items):
+        """
+        Packs a list of bytes into a zero-padded matrix with one row per item.
+
+        :param items: List of bytes.
+        :return: (matrix, lengths)
+        """
+        lengths = numpy.fromiter(map(len, items), dtype=numpy.intp, count=len(items))
+        width = int(lengths.max()) if len(items) else 0
+        matrix = numpy.zeros((len(items), width), dtype=numpy.uint8)
+        matrix[numpy.arange(width) < lengths[:, None]] = numpy.frombuffer(b"".join(items), dtype=numpy.uint8)
+        return matrix, lengths
+
+    @staticmethod
+    def _hash_many(function, items, matrix, lengths):
+        """
+        Returns the result of function(item) for each item as a uint64 array.
+
+        :param function: Hash function
+        :param items: List of bytes
+        :param matrix: Packed items, as returned by _pack()
+        :param lengths: Item lengths, as returned by _pack()
+        """
+        salt = b""
+        if isinstance(function, SaltedHash) and function.function in _VECTORIZED_HASHES:
+            salt, function = function.salt, function.function
+        if function not in _VECTORIZED_HASHES:
+            return numpy.fromiter(map(function, items), dtype=numpy.uint64, count=len(items))
+
+        start, step, finish = _VECTORIZED_HASHES[function]
+        state = numpy.full(len(items), start(salt), dtype=numpy.uint32)
+        for column in range(matrix.shape[1]):
+            state = numpy.where(lengths > column, step(state, matrix[:, column]), state)
+        if finish:
+            state = finish(state)
+        return state.astype(numpy.uint64)
+
+    def _positions(self, items):
+        """
+        Returns a (k, n) array of bit positions for n items.
+
+        :param items: List of items to hash.  bytes or str
+        """
+        items = list(map(self.coerce, items))
+        if isinstance(self.functions, DoubleHashing):
+            return self._double_positions(items)
+        matrix, lengths = self._pack(items)
+        return numpy.stack(list(
+            self._hash_many(function, items, matrix, lengths) % numpy.uint64(self.bits)
+            for function in self.functions
+        )) if items else numpy.zeros((self.k, 0), dtype=numpy.uint64)
+
+    def _double_positions(self, items):
+        """Returns a (k, n) array of bit positions for n items when using DoubleHashing."""
+        bits = numpy.uint64(self.bits)
+        digests = numpy.frombuffer(
+            b"".join(map(self.functions.digest, items)), dtype='<u8'
+        ).reshape(len(items), 2) % bits
+        h1, h2 = digests[:, 0], digests[:, 1]
+        h2[h2 == 0] = 1
+        probes = numpy.arange(self.k, dtype=numpy.uint64)[:, None]
+        return (h1 + probes * h2) % bits
+
+    @staticmethod
+    def _masks(positions):
+        """Converts bit positions into (byte offsets, bit masks)"""
+        return positions >> numpy.uint64(3), numpy.left_shift(1, positions & numpy.uint64(7)).astype(numpy.uint8)
+
+    def _batches(self, items):
+        it = iter(items)
+        while True:
+            batch = list(itertools.islice(it, self.BATCH_SIZE))
+            if not batch:
+                return
+            yield batch
+
+    def update(self, it):
+        """
+        Adds all items from the iterable.
+        """
+        self.update_many(it)
+
+    def update_many(self, items):
+        """
+        Adds all items from the iterable, hashing them in batches.
+
+        :param items: Iterable of items to add.  bytes or str
+        :return: The number of bits set that weren't previously
+        """
+        rv = 0
+        for batch in self._batches(items):
+            offsets, masks = self._masks(numpy.unique(self._positions(batch)))
+            new = int(numpy.count_nonzero((self.data[offsets] & masks) == 0))
+            numpy.bitwise_or.at(self.data, offsets, masks)
+            self._setbits += new
+            rv += new
+        return rv
+
+    def has_many(self, items):
+        """
+        Tests all items from the iterable, hashing them in batches.
+
+        :param items: Iterable of items to examine.  bytes or str
+        :return: A boolean array, one per item, that is True if the corresponding item is in the bloom filter.
+        """
+        result = []
+        for batch in self._batches(items):
+            offsets, masks = self._masks(self._positions(batch))
+            result.append(((self.data[offsets] & masks) != 0).all(axis=0))
+        return numpy.concatenate(result) if result else numpy.zeros(0, dtype=bool)
+
+
+def benchmark(count=20000, rate=0.01, max_hashes=10, lookups=20000):
+    """
+    Compares the per-lookup cost of the available hash sets and engines.
+
+    :param count: Number of random items to add.
+    :param rate: Target false positive rate.
+    :param max_hashes: Maximum number of hashes.
+    :param lookups: Number of lookups to time.
+    :return: A list of (description, seconds per lookup, false positive chance) tuples.
+    """
+    import random
+    import string
+    import timeit
+
+    rng = random.Random(0)
+    alphabet = string.ascii_lowercase + string.digits + '-'
+    words = list(''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 12))) for _ in range(count + lookups))
+    items, probes = words[:count], words[count:]
+    bits, hashes = BloomFilter.suggest_size_and_hashes(rate, count, max_hashes)
+
+    engines = [BloomFilter]
+    if NumpyBloomFilter.available:
+        engines.append(NumpyBloomFilter)
+    results = []
+    for hash_set in HASH_SETS:
+        for engine in engines:
+            bloom = engine(bits, HASH_SETS[hash_set](hashes))
+            bloom.update_many(items)
+            single = timeit.timeit(lambda: list(map(bloom.has, probes)), number=1) / lookups
+            batch = timeit.timeit(lambda: bloom.has_many(probes), number=1) / lookups
+            name = "{} k={} {}".format(hash_set, hashes, engine.__name__)
+            results.append((name + " has()", single, bloom.false_positive_chance()))
+            results.append((name + " has_many()", batch, bloom.false_positive_chance()))
+    return results
+
+
+if __name__ == '__main__':
+    for description, seconds, chance in benchmark():
+        print("{:45} {:8.2f} us/lookup  {:.2%} false positive chance".format(description, seconds * 1e6, chance))
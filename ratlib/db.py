@@ -14,6 +14,7 @@ import math
 
 import sqlalchemy as sa
 from sqlalchemy import sql, orm, schema
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 import alembic.command
@@ -190,6 +191,10 @@ class Fact(Base):
 class Status(Base):
     id = sa.Column(sa.Integer, primary_key=True)
     starsystem_refreshed = sa.Column(sa.DateTime(timezone=True), nullable=True)  # Time of last refresh
+    # Time upstream data was last found to be unchanged, which postpones the next refresh like a real one would.
+    starsystem_checked = sa.Column(sa.DateTime(timezone=True), nullable=True)
+    # HTTP validators (ETag, Last-Modified, length and content hash) of the data used by the last refresh, by URL.
+    starsystem_validators = sa.Column(postgresql.JSONB, nullable=True)
 
 
 class StarsystemUtilsMixin(Base):
@@ -240,6 +245,7 @@ class Starsystem(StarsystemUtilsMixin):
     word_ct = sa.Column(sa.Integer, nullable=False)
     xz = sa.Column(SQLPoint)
     y = sa.Column(sa.Numeric(asdecimal=False))
+    fingerprint = sa.Column(sa.BigInteger)  # Hash of name and coordinates.  See ratlib.starsystem.fingerprint()
 
 
     prefix = orm.relationship(StarsystemPrefix, backref=orm.backref('systems', lazy=True), lazy=True)
@@ -0,0 +1,83 @@
+"""
+Common handling of the binary files kept in workdir: a fixed header, then data.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import contextlib
+import mmap
+import os
+
+
+__all__ = ['MappedFile']
+
+
+class MappedFile:
+    """
+    Mixin for classes that persist themselves as a header followed by data.
+
+    Subclasses define FILE_MAGIC, FILE_VERSION, a FILE_HEADER struct whose first two fields are the magic and version,
+    and FILE_DESCRIPTION, which names the format in error messages.
+    """
+    FILE_MAGIC = None
+    FILE_VERSION = None
+    FILE_HEADER = None
+    FILE_DESCRIPTION = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def _create(cls, filename, *fields):
+        """
+        Context manager that opens a new file for writing with its header already written.
+
+        Data goes to filename + '.tmp', which replaces filename when the block exits normally and is removed otherwise.
+
+        :param filename: Path to write to.
+        :param fields: Header fields after the magic and version.
+        """
+        tempname = filename + '.tmp'
+        try:
+            with open(tempname, 'wb') as f:
+                f.write(cls.FILE_HEADER.pack(cls.FILE_MAGIC, cls.FILE_VERSION, *fields))
+                yield f
+            os.replace(tempname, filename)
+        finally:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+
+    @classmethod
+    def _read_header(cls, f):
+        """
+        Reads and validates a file header.
+
+        :param f: File-like object, positioned at the start of the file.
+        :return: A tuple of the header fields after the magic and version.
+        :raises: ValueError if the header is truncated, has the wrong magic or is from an unsupported version.
+        """
+        raw = f.read(cls.FILE_HEADER.size)
+        if len(raw) != cls.FILE_HEADER.size:
+            raise ValueError("Truncated {} header".format(cls.FILE_DESCRIPTION))
+        magic, version, *fields = cls.FILE_HEADER.unpack(raw)
+        if magic != cls.FILE_MAGIC:
+            raise ValueError("Not a {} file".format(cls.FILE_DESCRIPTION))
+        if version != cls.FILE_VERSION:
+            raise ValueError("Unsupported {} version {}".format(cls.FILE_DESCRIPTION, version))
+        return tuple(fields)
+
+    @classmethod
+    def _map(cls, f, size, access=mmap.ACCESS_READ):
+        """
+        Memory-maps the first size bytes of a file, header included.
+
+        :param f: Open file.
+        :param size: Expected size of the file.
+        :param access: mmap access mode.
+        :raises: ValueError if the file is shorter than size.
+        """
+        if os.fstat(f.fileno()).st_size < size:
+            raise ValueError("Truncated {}".format(cls.FILE_DESCRIPTION))
+        return mmap.mmap(f.fileno(), size, access=access)
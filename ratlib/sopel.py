@@ -70,7 +70,14 @@ class RatbotConfigurationSection(StaticSection):
     shortenertoken = types.ValidatedAttribute('shortenertoken', str, default='asdf')
     debug_channel = types.ValidatedAttribute('debug_channel', str, default='#mechadeploy')
     chunked_systems = BooleanAttribute('chunked_systems', default=True)  # Should be edsm_chunked_systems to fit others
+    edsm_chunk_workers = types.ValidatedAttribute('edsm_chunk_workers', int, default=4)
+    edsm_resumable = BooleanAttribute('edsm_resumable', default=False)
+    edsm_shadow_tables = BooleanAttribute('edsm_shadow_tables', default=False)
+    edsm_copy_format = types.ChoiceAttribute('edsm_copy_format', ['text', 'binary'], default='text')
     hastebin_url = types.ValidatedAttribute('hastebin_url', 'str', default="http://hastebin.com/")
+    bloom_max_fp = types.ValidatedAttribute('bloom_max_fp', float, default=0.02)
+    system_store = BooleanAttribute('system_store', default=False)
+    search_prefilter = BooleanAttribute('search_prefilter', default=False)
 
 
 def parameterize(params=None, usage=None, split=re.compile(r'\s+').split):
@@ -205,12 +212,21 @@ def configure(config):
     config.ratbot.configure_setting('edsm_maxage', "Maximum age of EDSM system data in seconds")
     config.ratbot.configure_setting('edsm_autorefresh', "EDSM autorefresh frequency in seconds (0=disable)")
     config.ratbot.configure_setting('edsm_db', "EDSM Database path (relative to workdir)")
+    config.ratbot.configure_setting('edsm_chunk_workers', "Number of EDSM chunks to download at once")
+    config.ratbot.configure_setting('edsm_resumable', "Checkpoint EDSM refreshes so they can resume if interrupted")
+    config.ratbot.configure_setting(
+        'edsm_shadow_tables', "Build new starsystem tables during EDSM refreshes and swap them in at the end"
+    )
+    config.ratbot.configure_setting('edsm_copy_format', "Format used to load EDSM data into the database")
     config.ratbot.configure_setting('websocketurl', "The url for the Websocket to listen on")
     config.ratbot.configure_setting('websocketport', "The port for the Websocket to listen on")
     config.ratbot.configure_setting('shortenerurl', "The url for the shortener to listen on")
     config.ratbot.configure_setting('shortenertoken', "The Auth token the shortener should use")
     config.ratbot.configure_setting('debug_channel', "Channel for debug output")
     config.ratbot.configure_setting('hastebin_url', "Hastebin base URL")
+    config.ratbot.configure_setting('bloom_max_fp', "Bloom filter false positive chance that triggers a rebuild")
+    config.ratbot.configure_setting('system_store', "True to look up system names without querying the database")
+    config.ratbot.configure_setting('search_prefilter', "True to narrow down !search candidates with pg_trgm first")
 
 
 def setup(bot):
@@ -257,7 +273,10 @@ def setup(bot):
     bot.memory['ratbot']['stats'] = SopelMemory()
     bot.memory['ratbot']['stats']['started'] = datetime.datetime.now(tz=datetime.timezone.utc)
     ratlib.db.setup(bot)
-    ratlib.starsystem.refresh_bloom(bot)
+    ratlib.starsystem.load_bloom(bot)
+    ratlib.starsystem.refresh_prefixes(bot)
+    if bot.config.ratbot.system_store:
+        ratlib.starsystem.load_system_store(bot)
     ratlib.starsystem.refresh_database(
         bot,
         callback=lambda: print("EDSM database is out of date.  Starting background refresh."),
@@ -0,0 +1,182 @@
+"""
+Readers for the formats that starsystem data is published in.
+
+Copyright (c) 2017 The Fuel Rats Mischief, 
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import csv
+import json
+import os
+from urllib.parse import urlparse
+
+
+__all__ = ['FORMATS', 'detect_format', 'parse', 'parse_csv', 'parse_json_lines', 'parse_json_array']
+
+
+def _coords(x, y, z):
+    """Returns coordinates as a tuple of strings, or None if any of them are missing."""
+    if x is None or y is None or z is None or '' in (x, y, z):
+        return None
+    return str(x), str(y), str(z)
+
+
+def _record(obj):
+    """
+    Converts a decoded JSON system into a record.  Coordinates may either be nested in 'coords' (as EDSM does) or
+    stored directly on the system (as EDDB does).
+    """
+    coords = obj.get('coords') or obj
+    return str(obj['id']), obj['name'], _coords(coords.get('x'), coords.get('y'), coords.get('z'))
+
+
+def parse_csv(fileobj, fieldnames=None):
+    """
+    Parses starsystem data in CSV format, with at least 'id', 'name', 'x', 'y' and 'z' columns.
+
+    :param fileobj: Text file-like object, or any other iterable of lines.
+    :param fieldnames: Column names.  If omitted, they are read from the first line.
+    :return: Generator yielding a tuple of (id, name, coords) for each system.  coords is either a tuple of (x, y, z)
+        strings or None.
+    """
+    for row in csv.DictReader(fileobj, fieldnames=fieldnames):
+        yield row['id'], row['name'], _coords(row['x'], row['y'], row['z'])
+
+
+def parse_json_lines(fileobj):
+    """
+    Parses starsystem data consisting of one JSON object per line.
+
+    :param fileobj: Text file-like object, or any other iterable of lines.
+    :return: Generator yielding a tuple of (id, name, coords) for each system, as with parse_csv()
+    """
+    for line in fileobj:
+        line = line.strip()
+        if line:
+            yield _record(json.loads(line))
+
+
+def parse_json_array(fileobj, chunk_size=1 << 16):
+    """
+    Parses starsystem data consisting of a single JSON array of objects.
+
+    The array is decoded one element at a time, so memory use depends on the size of the largest element rather than
+    the size of the array.
+
+    :param fileobj: Text file-like object.
+    :param chunk_size: Number of characters to read at a time.
+    :return: Generator yielding a tuple of (id, name, coords) for each system, as with parse_csv()
+    :raises: ValueError if the data is not a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        # Discards what has been parsed already and reads more.  Returns False at the end of the file.
+        nonlocal buffer, pos, eof
+        data = fileobj.read(chunk_size)
+        buffer = buffer[pos:] + data
+        pos = 0
+        eof = not data
+        return not eof
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    skip_whitespace()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    first = True
+    while True:
+        skip_whitespace()
+        if buffer[pos:pos + 1] == ']':
+            return
+        if not first:
+            if buffer[pos:pos + 1] != ',':
+                raise ValueError("Expected ',' or ']' at character {} of buffer".format(pos))
+            pos += 1
+            skip_whitespace()
+        first = False
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Probably an element that continues past the end of the buffer.
+                if eof or not fill():
+                    raise
+                continue
+            if end == len(buffer) and not eof:
+                # A number could be cut off at the end of the buffer; read more and decode it again to be sure.
+                # (Elements are normally objects, so this is rare.)
+                fill()
+                continue
+            break
+        pos = end
+        yield _record(obj)
+
+
+FORMATS = {
+    'csv': parse_csv,
+    'jsonl': parse_json_lines,
+    'json': parse_json_array,
+}
+
+# Format by file extension, and by content type.
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'json'}
+CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+    'application/json': 'json',
+}
+GZIP_CONTENT_TYPES = {'application/gzip', 'application/x-gzip'}
+
+
+def detect_format(name, content_type=None, default='csv'):
+    """
+    Determines the format of starsystem data from its file extension, or failing that its content type.
+
+    :param name: URL or file name.
+    :param content_type: Content type, if known.
+    :param default: Format to assume if it can't be determined.
+    :return: A tuple of (format, compressed), where format is a key of FORMATS and compressed is True if the data is
+        gzip-compressed.
+    """
+    path = (urlparse(name).path if '://' in name else name).lower()
+    compressed = path.endswith('.gz')
+    if compressed:
+        path = path[:-3]
+    fmt = EXTENSIONS.get(os.path.splitext(path)[1])
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in GZIP_CONTENT_TYPES:
+        compressed = True
+    elif fmt is None:
+        fmt = CONTENT_TYPES.get(content_type)
+    return fmt or default, compressed
+
+
+def parse(fileobj, fmt='csv', fieldnames=None):
+    """
+    Parses starsystem data in any supported format.
+
+    :param fileobj: Text file-like object.
+    :param fmt: Key of FORMATS.
+    :param fieldnames: Column names, for CSV data that doesn't start with them.
+    :return: Generator yielding a tuple of (id, name, coords) for each system, as with parse_csv()
+    """
+    if fmt == 'csv':
+        return parse_csv(fileobj, fieldnames)
+    return FORMATS[fmt](fileobj)
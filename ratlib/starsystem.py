@@ -11,10 +11,23 @@ Licensed under the BSD 3-Clause License.
 See LICENSE.md
 """
 import io
+import os
+import math
+import collections
+import contextlib
+import gzip
+import mmap
+import shutil
+import itertools
 import datetime
 import re
-import operator
 import threading
+import time
+import queue
+import struct
+import hashlib
+import functools
+import concurrent.futures
 from urllib.parse import urljoin
 import csv
 try:
@@ -25,27 +38,1029 @@ except ImportError:
 import requests
 import sqlalchemy as sa
 from sqlalchemy import sql, orm, schema
+from sqlalchemy.dialects import postgresql
 
 from ratlib.db import get_status, get_session, with_session, Starsystem, StarsystemPrefix, SQLPoint, Point
-from ratlib.bloom import BloomFilter
+from ratlib.bloom import BloomFilter, NumpyBloomFilter, HASH_SETS
+from ratlib.systemstore import SystemStore
+from ratlib import sourceformats
 from ratlib.timeutil import format_timestamp
-from ratlib.util import timed, TimedResult
+from ratlib.util import timed, TimedResult, LRUCache
 
-FLUSH_THRESHOLD = 25000  # Chunk size when refreshing starsystems
+FLUSH_THRESHOLD = 25000  # Progress reporting/fetch chunk size when refreshing starsystems
+COPY_BATCH = 1000  # Number of parsed systems handed to COPY at once
+COPY_FORMAT = 'text'  # Default format for COPYing starsystems.  See COPY_FORMATS.
+PIPELINE_DEPTH = 16  # Number of parsed batches that may wait for COPY before parsing pauses
+BLOOM_FILENAME = 'starsystem.bloom'  # Name of the persisted bloom filter, relative to workdir
+SYSTEM_STORE_FILENAME = 'starsystem.store'  # Name of the columnar starsystem snapshot, relative to workdir
+SCAN_CACHE_SIZE = 1024  # Number of lines to remember scan_for_systems results for
+SYSTEM_CACHE_SIZE = 1024  # Number of systems lookup_system() remembers
+SYSTEM_NEGATIVE_CACHE_SIZE = 1024  # Number of names lookup_system() remembers not finding
+SNAPSHOT_DIRNAME = 'starsystem.snapshot'  # Directory holding local copies of starsystem data, relative to workdir
+SNAPSHOT_ORDER_FILENAME = 'order'  # Snapshot file names in the order their data was downloaded, within SNAPSHOT_DIRNAME
+SNAPSHOT_COMPRESSION = 1  # gzip compression level of local snapshots; favors speed, since the data is large
+CHECKPOINT_THRESHOLD = 100000  # Number of systems loaded between checkpoints in resumable mode
+STAGING_TABLE = '_starsystem_staging'  # Table starsystem data is loaded into in resumable mode
+CHECKPOINT_TABLE = '_starsystem_checkpoint'  # Progress of loading STAGING_TABLE in resumable mode
+SHADOW_SUFFIX = '__shadow'  # Suffix of the tables (and their indexes) built by a refresh in shadow table mode
+SWAP_LOCK_TIMEOUT = 2  # Seconds a shadow table swap waits for the live tables before backing off
+SWAP_ATTEMPTS = 5  # Number of times a shadow table swap tries to lock the live tables before the refresh fails
+SEARCH_SIMILARITY_LIMITS = (0.4, 0.2)  # Trigram similarity limits search_systems()'s prefilter tries, in order
+PREFIX_SEARCH_CANDIDATES = 1000  # Maximum number of names starting with a search that search_prefix() will rank
 
 
 class ConcurrentOperationError(RuntimeError):
     pass
 
 
+COPY_COLUMNS = ['eddb_id', 'name_lower', 'name', 'first_word', 'word_ct', 'xz', 'y', 'fingerprint']  # Columns of the temptable
+
+
+def _temp_starsystem_table(name='_temp_new_starsystem', unlogged=False, metadata=None):
+    """
+    Returns the definition of the temporary table that starsystem data is loaded into during a refresh.
+
+    :param name: Table name.
+    :param unlogged: If True, the table is a permanent (but unlogged) table with a primary key instead, so that it
+        survives until the refresh using it completes.
+    :param metadata: MetaData instance to use.
+    """
+    if unlogged:
+        table_args = {'prefixes': ['UNLOGGED']}
+    else:
+        table_args = {'prefixes': ['TEMPORARY'], 'postgresql_on_commit': 'DROP'}
+    return sa.Table(
+        name, metadata if metadata is not None else sa.MetaData(),
+        # Becomes the primary key once loaded; declaring it here would make COPY maintain the index row by row.
+        sa.Column('eddb_id', sa.Integer, primary_key=unlogged, autoincrement=False),
+        sa.Column('name_lower', sa.Text(collation="C")),
+        sa.Column('name', sa.Text(collation="C")),
+        sa.Column('first_word', sa.Text(collation="C")),
+        sa.Column('word_ct', sa.Integer),
+        sa.Column('xz', SQLPoint),
+        sa.Column('y', sa.Float),  # Same type as starsystem.y, which also makes it cheap to send in binary.
+        sa.Column('fingerprint', sa.BigInteger),
+        **table_args
+    )
+
+
+def fingerprint(name, coords):
+    """
+    Returns a hash of a system's name and coordinates, used to tell whether a system has changed between refreshes.
+
+    :param name: System name, with its original capitalization.
+    :param coords: Tuple of (x, y, z), or None if the coordinates are unknown.
+    :return: A signed 64-bit integer.
+    """
+    if coords:
+        # Normalize so that e.g. "1.50" and "1.5" hash the same.
+        text = "\0".join((name,) + tuple(repr(float(c)) for c in coords))
+    else:
+        text = name
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def _parse_systems(fileobj, fmt='csv', fieldnames=None):
+    """
+    Parses starsystem data.
+
+    :param fileobj: Text file-like object, or (for line-based formats) any other iterable of lines.
+    :param fmt: Format of the data; a key of ratlib.sourceformats.FORMATS
+    :param fieldnames: CSV column names.  If omitted, they are read from the first line.
+    :return: Generator yielding a tuple of (eddb_id, name_lower, name, first_word, word_ct, coords, fingerprint) for
+        each system.  eddb_id is a string, word_ct is an int, coords is either a tuple of (x, y, z) strings or None, and
+        fingerprint is the result of fingerprint().
+    """
+    for eddb_id, name, coords in sourceformats.parse(fileobj, fmt, fieldnames):
+        # Reformat system info
+        name, word_ct = re.subn(r'\s+', ' ', name.strip())
+        name_lower = name.lower()
+        first_word, *unused = name_lower.split(" ", 1)
+        word_ct += 1
+        yield eddb_id, name_lower, name, first_word, word_ct, coords, fingerprint(name, coords)
+
+
+class TextCopyFormat:
+    """
+    Encodes parsed systems for COPY in PostgreSQL's text format.
+    """
+    options = "FORMAT text, NULL ''"
+    header = trailer = ''
+    join = ''.join
+
+    @staticmethod
+    def row(system):
+        eddb_id, name_lower, name, first_word, word_ct, coords, fingerprint = system
+        if coords:
+            xz = "({},{})".format(coords[0], coords[2])
+            y = coords[1]
+        else:
+            xz = y = ''
+        return "\t".join((str(eddb_id), name_lower, name, first_word, str(word_ct), xz, y, str(fingerprint))) + "\n"
+
+
+class BinaryCopyFormat:
+    """
+    Encodes parsed systems for COPY in PostgreSQL's binary format.
+
+    This spares the server from parsing numbers and point literals for every row.
+    """
+    options = "FORMAT binary"
+    header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)  # Signature, flags, header extension length
+    trailer = struct.pack('!h', -1)
+    join = b''.join
+
+    # Field count followed by eddb_id, as (length, value)
+    _start = struct.Struct('!hii')
+    _text = struct.Struct('!i')
+    # word_ct, then either xz and y...
+    _coords = struct.Struct('!iiiddid')
+    # ... or NULLs.
+    _no_coords = struct.Struct('!iiii')
+    _fingerprint = struct.Struct('!iq')
+
+    @classmethod
+    def row(cls, system):
+        eddb_id, name_lower, name, first_word, word_ct, coords, fingerprint = system
+        parts = [cls._start.pack(len(COPY_COLUMNS), 4, int(eddb_id))]
+        for text in (name_lower, name, first_word):
+            text = text.encode('utf-8')
+            parts.append(cls._text.pack(len(text)))
+            parts.append(text)
+        if coords:
+            x, y, z = coords
+            parts.append(cls._coords.pack(4, word_ct, 16, float(x), float(z), 8, float(y)))
+        else:
+            parts.append(cls._no_coords.pack(4, word_ct, -1, -1))
+        parts.append(cls._fingerprint.pack(8, fingerprint))
+        return b''.join(parts)
+
+
+COPY_FORMATS = {
+    'text': TextCopyFormat,
+    'binary': BinaryCopyFormat,
+}
+
+
+class _Deduplicator:
+    """
+    Removes repeated eddb_ids from parsed systems while they are streamed to the database.
+
+    Seen IDs are tracked in a bitmap, which stays at a few megabytes even for tens of millions of systems.  The first
+    occurrence of an ID has usually been sent by the time a repeat turns up, so repeats are withheld and kept in
+    `duplicates` (latest one wins) to be swapped in once the main COPY is done.
+    """
+    def __init__(self):
+        self._seen = bytearray()
+        self._other = set()  # IDs that don't fit the bitmap (negative or absurdly large)
+        self._lock = threading.Lock()
+        self.duplicates = {}
+
+    def _check(self, eddb_id):
+        """Marks eddb_id as seen, returning True if it already was."""
+        if eddb_id < 0 or eddb_id >= 2**32:
+            if eddb_id in self._other:
+                return True
+            self._other.add(eddb_id)
+            return False
+        ix, bit = eddb_id >> 3, 1 << (eddb_id & 7)
+        if ix >= len(self._seen):
+            self._seen.extend(bytes(max(ix + 1, 2*len(self._seen)) - len(self._seen)))
+        elif self._seen[ix] & bit:
+            return True
+        self._seen[ix] |= bit
+        return False
+
+    def mark(self, ids):
+        """
+        Marks IDs as seen, e.g. because they were loaded before a refresh was resumed.
+
+        :param ids: Iterable of eddb_ids.
+        """
+        with self._lock:
+            for eddb_id in ids:
+                self._check(eddb_id)
+
+    def filter(self, systems):
+        """
+        Filters a batch of parsed systems.  Safe to call from multiple threads.
+
+        :param systems: List of systems, as produced by _parse_systems()
+        :return: List of systems whose eddb_id has not been seen before.
+        """
+        result = []
+        with self._lock:
+            for system in systems:
+                eddb_id = int(system[0])
+                if self._check(eddb_id):
+                    self.duplicates[eddb_id] = system
+                else:
+                    result.append(system)
+        return result
+
+
+class _PrefixCounter:
+    """
+    Counts systems by prefix (first_word, word_ct) while they are streamed to the database, so that prefix statistics
+    can be computed without joining every prefix to its systems.  (Only systems that are no longer published still
+    have to be counted in the database.)
+
+    The counts are only useful if every system in the data went through them.  Anything that causes systems to be
+    skipped (an unchanged or unreadable chunk, a load resumed by an earlier process) must clear `complete`.
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.complete = True
+        self._lock = threading.Lock()
+
+    def add(self, systems):
+        """
+        Counts a batch of systems.  Safe to call from multiple threads.
+
+        :param systems: List of systems, as produced by _parse_systems()
+        """
+        batch = collections.Counter((system[3], system[4]) for system in systems)
+        with self._lock:
+            self.counts.update(batch)
+
+    def remove(self, prefixes):
+        """
+        Uncounts systems, e.g. because they were replaced by a later duplicate.
+
+        :param prefixes: Iterable of (first_word, word_ct) tuples, one per system.
+        """
+        batch = collections.Counter((first_word, word_ct) for first_word, word_ct in prefixes)
+        with self._lock:
+            self.counts.subtract(batch)
+
+
+def _encode(systems, encoder, dedupe=None, counter=None):
+    """
+    Encodes a batch of parsed systems for COPY.
+
+    :param systems: List of systems, as produced by _parse_systems()
+    :param encoder: One of COPY_FORMATS.
+    :param dedupe: Optional _Deduplicator.
+    :param counter: Optional _PrefixCounter, which counts the systems that are actually encoded.
+    :return: A tuple of (data, count)
+    """
+    if dedupe is not None:
+        systems = dedupe.filter(systems)
+    if counter is not None:
+        counter.add(systems)
+    return encoder.join(map(encoder.row, systems)), len(systems)
+
+
+class _HashingReader(io.RawIOBase):
+    """
+    Binary reader that hashes everything read through it, and reports the result once the end is reached.
+    """
+    def __init__(self, raw, callback):
+        """
+        :param raw: Binary file-like object to read from.
+        :param callback: Function called with (length, hexdigest) at the end of the stream.
+        """
+        self._raw = raw
+        self._callback = callback
+        self._hash = hashlib.sha256()
+        self._length = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._raw.read(len(b))
+        if not data:
+            if self._callback:
+                self._callback(self._length, self._hash.hexdigest())
+                self._callback = None
+            return 0
+        b[:len(data)] = data
+        self._hash.update(data)
+        self._length += len(data)
+        return len(data)
+
+
+def _workdir_path(bot, filename):
+    """Returns the path to a file or directory in workdir, such as SNAPSHOT_DIRNAME or BLOOM_FILENAME."""
+    return os.path.join(bot.config.ratbot.workdir or '.', filename)
+
+
+def _snapshot_base(bot, url):
+    """
+    Returns the path to the local snapshot of the starsystem data at url, minus the extensions that identify its format.
+    """
+    return os.path.join(_workdir_path(bot, SNAPSHOT_DIRNAME), hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+
+
+def _find_snapshot(base):
+    """
+    Returns the path to an existing snapshot, or None if there isn't one.
+
+    :param base: Result of _snapshot_base()
+    """
+    for fmt in sourceformats.FORMATS:
+        path = "{}.{}.gz".format(base, fmt)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _snapshot_format(path):
+    """Returns the format of the data in a snapshot, as a key of ratlib.sourceformats.FORMATS"""
+    return sourceformats.detect_format(path)[0]
+
+
+def list_snapshots(bot):
+    """
+    Returns the paths of all local snapshots of starsystem data.
+
+    They are in the order that the last refresh downloaded them in (see _write_snapshot_order()), so that reloading
+    them resolves duplicate systems the same way that refresh did.  Snapshots missing from that order come last, sorted
+    by name.
+    """
+    path = _workdir_path(bot, SNAPSHOT_DIRNAME)
+    if not os.path.isdir(path):
+        return []
+    names = set(name for name in os.listdir(path) if name.endswith('.gz'))
+    try:
+        with open(os.path.join(path, SNAPSHOT_ORDER_FILENAME), encoding='utf-8') as f:
+            order = list(line.strip() for line in f)
+    except FileNotFoundError:
+        order = []
+    ordered = list(name for name in order if name in names)
+    ordered.extend(sorted(names.difference(ordered)))
+    return list(os.path.join(path, name) for name in ordered)
+
+
+def _write_snapshot_order(bot, paths):
+    """
+    Records the order of local snapshots for list_snapshots().
+
+    :param paths: Paths to snapshots, in the order their data was loaded.
+    """
+    filename = os.path.join(_workdir_path(bot, SNAPSHOT_DIRNAME), SNAPSHOT_ORDER_FILENAME)
+    tempname = filename + '.tmp'
+    with open(tempname, 'w', encoding='utf-8') as f:
+        f.writelines(os.path.basename(path) + "\n" for path in paths)
+    os.replace(tempname, filename)
+
+
+@contextlib.contextmanager
+def _read_snapshot(path):
+    """
+    Opens a local snapshot for reading.
+
+    The compressed file is memory-mapped rather than read, which saves a copy (and a system call) per block.
+
+    :param path: Path to the snapshot.
+    :return: Context manager yielding a binary file-like object with the uncompressed data.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        with gzip.GzipFile(fileobj=buffer, mode='rb') as data:
+            yield data
+
+
+class _SourceTracker:
+    """
+    Keeps track of the HTTP validators of starsystem data, so that data which hasn't changed since the last refresh
+    isn't downloaded (or loaded) again.
+
+    Validators for each URL are stored as a dict of 'etag', 'last_modified', 'length' and 'sha256'.
+    """
+    def __init__(self, known=None, conditional=True):
+        """
+        :param known: Validators from the last refresh, by URL.
+        :param conditional: If False, known validators are not sent with requests, so everything is downloaded.
+        """
+        self.known = dict(known or {})
+        self.conditional = conditional
+        self.current = {}  # Validators of the data we've seen during this refresh, by URL.
+        self.unchanged = set()  # URLs that the server said were unchanged.
+        self._lock = threading.Lock()
+
+    def get(self, url, conditional=True):
+        """
+        Requests a URL, conditionally if possible.
+
+        :param url: URL to request.
+        :param conditional: If False, always request the full data.  (e.g. because our copy of it is missing)
+        :return: A streaming requests.Response, or None if the data at url is unchanged.
+        """
+        known = self.known.get(url) if self.conditional and conditional else None
+        headers = {}
+        if known:
+            if known.get('etag'):
+                headers['If-None-Match'] = known['etag']
+            if known.get('last_modified'):
+                headers['If-Modified-Since'] = known['last_modified']
+        response = requests.get(url, stream=True, headers=headers)
+        if headers and response.status_code == 304:
+            response.close()
+            with self._lock:
+                self.unchanged.add(url)
+                self.current[url] = known
+            return None
+        response.raise_for_status()
+        return response
+
+    def download(self, url, response, base):
+        """
+        Saves a response's body to a compressed snapshot, recording its validators.
+
+        The format of the data is detected from the URL or the response's content type, and becomes part of the
+        snapshot's name.  Data that is already gzip-compressed is stored as-is.
+
+        Until the download completes, data goes to a '.part' file next to the snapshot.
+
+        :param url: URL of the response.
+        :param response: Response returned by get()
+        :param base: Path to write to, minus extensions.  See _snapshot_base()
+        :return: Path of the snapshot.
+        """
+        def done(length, digest):
+            with self._lock:
+                self.current[url] = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'length': length,
+                    'sha256': digest,
+                }
+
+        # Newer urllib3 versions close the stream as soon as it's exhausted, which makes further reads raise a
+        # ValueError.
+        if hasattr(response.raw, 'auto_close'):
+            response.raw.auto_close = False
+        fmt, compressed = sourceformats.detect_format(url, response.headers.get('Content-Type'))
+        # Without decode_content, requests leaves a gzip Content-Encoding in place on the raw stream.
+        compressed = compressed or response.headers.get('Content-Encoding', '').lower() == 'gzip'
+        filename = "{}.{}.gz".format(base, fmt)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tempname = filename + '.part'
+        stream = _HashingReader(response.raw, done)
+        with (open(tempname, 'wb') if compressed else gzip.open(tempname, 'wb', SNAPSHOT_COMPRESSION)) as f:
+            shutil.copyfileobj(stream, f, 1 << 20)
+        os.replace(tempname, filename)
+        # If the format changed, the old snapshot is obsolete.
+        for other in sourceformats.FORMATS:
+            if other != fmt and os.path.exists("{}.{}.gz".format(base, other)):
+                os.remove("{}.{}.gz".format(base, other))
+        return filename
+
+    def discard(self, url):
+        """
+        Forgets the validators of data that couldn't be loaded, so that the next refresh retrieves it again in full
+        rather than being told that it is unchanged.
+
+        :param url: URL of the data.
+        """
+        with self._lock:
+            self.current.pop(url, None)
+
+    @property
+    def changed(self):
+        """True if the data seen during this refresh differs from the data seen by the last one."""
+        if set(self.current) != set(self.known):
+            return True
+        return any(
+            (self.current[url].get('length'), self.current[url].get('sha256')) !=
+            (self.known[url].get('length'), self.known[url].get('sha256'))
+            for url in self.current
+        )
+
+
+def _read_batches(paths, log, encoder=TextCopyFormat, dedupe=None, counter=None, failed=None):
+    """
+    Parses local snapshots of starsystem data, yielding them in batches of up to COPY_BATCH systems.
+
+    Errors reading a snapshot are logged, and loading continues with the next one.
+
+    :param paths: Snapshots to read.
+    :param log: Logging function.
+    :param encoder: One of COPY_FORMATS.
+    :param dedupe: Optional _Deduplicator.
+    :param counter: Optional _PrefixCounter.
+    :param failed: Optional function called with the path of each snapshot that couldn't be read.
+    :return: Generator yielding a tuple of (data, count): systems encoded for COPY, and the number of systems.
+    """
+    for path in paths:
+        log("Reading starsystem data from {}", path)
+        rows = []
+        try:
+            with _read_snapshot(path) as f:
+                for system in _parse_systems(io.TextIOWrapper(f, encoding='utf-8'), _snapshot_format(path)):
+                    rows.append(system)
+                    if len(rows) >= COPY_BATCH:
+                        yield _encode(rows, encoder, dedupe, counter)
+                        rows = []
+        except Exception as ex:
+            log("Failed to read data")
+            import traceback
+            traceback.print_exc()
+            if counter is not None:
+                counter.complete = False
+            if failed:
+                failed(path)
+        if rows:
+            yield _encode(rows, encoder, dedupe, counter)
+
+
+class _CopyStream:
+    """
+    Read-only file-like object that produces COPY data from an iterable of (data, count) batches, so that a single COPY
+    can consume an entire refresh without the data ever being buffered in full.
+    """
+    def __init__(self, batches, progress=None, encoder=TextCopyFormat):
+        """
+        :param batches: Iterable of (data, count) tuples, as produced by _read_batches()
+        :param progress: Optional function called with the total number of systems read so far, after each batch.
+        :param encoder: One of COPY_FORMATS.  Its header and trailer are added around the batches.
+        """
+        self._batches = itertools.chain([(encoder.header, 0)], batches, [(encoder.trailer, 0)])
+        self._progress = progress
+        self._text = ''
+        self._pos = 0
+        self.count = 0  # Total number of systems read so far.
+
+    def read(self, size=-1):
+        while self._pos >= len(self._text):
+            try:
+                self._text, count = next(self._batches)
+            except StopIteration:
+                return self._text[:0]
+            self._pos = 0
+            self.count += count
+            if self._progress:
+                self._progress(self.count)
+        if size is None or size < 0:
+            end = len(self._text)
+        else:
+            end = self._pos + size
+        result = self._text[self._pos:end]
+        self._pos += len(result)
+        return result
+
+
+def _pipeline(source, maxsize=PIPELINE_DEPTH):
+    """
+    Iterates over source in a background thread, handing its items over through a bounded queue.
+
+    This lets the producer (e.g. downloading and parsing) run concurrently with whatever consumes the result (e.g. a
+    COPY), while never letting more than maxsize items pile up.  Exceptions raised by the producer are re-raised in the
+    consumer.
+
+    :param source: Iterable to consume in the background.
+    :param maxsize: Maximum number of items waiting in the queue.
+    :return: Generator yielding each item of source.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in source:
+                if not put((item, None)):
+                    return
+        except BaseException as ex:
+            put((done, ex))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, name='starsystem-pipeline', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, ex = items.get()
+            if ex is not None:
+                raise ex
+            if item is done:
+                return
+            yield item
+    finally:
+        # Tell the producer to give up if we're bailing early.
+        stop.set()
+
+
+def _load_snapshot(path):
+    """
+    Parses an entire local snapshot of starsystem data at once.  Called from worker threads in chunked mode.
+
+    :param path: Path to the snapshot.
+    :return: A tuple of (systems, seconds): a list of the snapshot's systems, as produced by _parse_systems(), and the
+        time taken.
+    """
+    with timed() as t:
+        with _read_snapshot(path) as f:
+            systems = list(_parse_systems(io.TextIOWrapper(f, encoding='utf-8'), _snapshot_format(path)))
+    return systems, t.seconds
+
+
+def _fetch_chunk(url, base, tracker):
+    """
+    Downloads one chunk of starsystem data to its local snapshot and parses it.  Called from worker threads in chunked
+    mode.
+
+    :param url: URL of the chunk.
+    :param base: Path to the chunk's local snapshot, minus extensions.  See _snapshot_base()
+    :param tracker: _SourceTracker
+    :return: A tuple of (systems, seconds): a list of the chunk's systems, and the time taken.  systems is None if the
+        chunk is unchanged since the last refresh.
+    """
+    with timed() as t:
+        # Without a snapshot to fall back on, we need the data even if it hasn't changed.
+        response = tracker.get(url, conditional=_find_snapshot(base) is not None)
+        if response is not None:
+            path = tracker.download(url, response, base)
+    if response is None:
+        return None, t.seconds
+    systems, seconds = _load_snapshot(path)
+    return systems, t.seconds + seconds
+
+
+def _chunk_batches(chunks, log, stats, counter, workers=1, encoder=TextCopyFormat, dedupe=None, failed=None):
+    """
+    Loads chunks of starsystem data on a thread pool, yielding them for COPY in order.
+
+    Chunks are downloaded and parsed in parallel, but de-duplicated and encoded in the order they were given, so that
+    which copy of a repeated system wins doesn't depend on which chunk happened to finish first.  Chunks that finish
+    early wait for the ones before them; no more than twice as many as there are workers are in flight at once.
+
+    Chunks that fail to load are logged and skipped.
+
+    :param chunks: Iterable of (name, function) tuples.  Each function is called from a worker thread, and returns a
+        tuple of (systems, seconds) like _fetch_chunk()
+    :param log: Logging function.
+    :param stats: List that a dict of statistics is appended to for each chunk that loaded, in order.
+    :param counter: _PrefixCounter.  Marked incomplete if any chunk's systems aren't loaded.
+    :param workers: Number of chunks to load at once.
+    :param encoder: One of COPY_FORMATS.
+    :param dedupe: Optional _Deduplicator.
+    :param failed: Optional function called with the name of each chunk that failed to load.
+    :return: Generator yielding a tuple of (data, count) for each chunk that changed.
+    """
+    chunks = iter(chunks)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for name, fn in itertools.islice(chunks, 2*workers - len(pending)):
+                pending.append((name, pool.submit(fn)))
+            if not pending:
+                return
+            name, future = pending.popleft()
+            try:
+                systems, seconds = future.result()
+            except Exception as ex:
+                log("Failed to retrieve data at {}", name)
+                import traceback
+                traceback.print_exc()
+                counter.complete = False
+                if failed:
+                    failed(name)
+                continue
+            if systems is None:
+                # Its systems weren't counted, since they weren't loaded.
+                counter.complete = False
+                stats.append({'url': name, 'systems': 0, 'download': seconds, 'unchanged': True})
+                continue
+            text, count = _encode(systems, encoder, dedupe, counter)
+            stats.append({'url': name, 'systems': count, 'download': seconds, 'unchanged': False})
+            yield text, count
+
+
+def _load_resumable(bot, engine, url, tracker, encoder, log, progress=None, local=False, counter=None):
+    """
+    Loads starsystem data into STAGING_TABLE, committing a checkpoint every CHECKPOINT_THRESHOLD systems.
+
+    The data is downloaded to its local snapshot first.  If a previous call was interrupted and the snapshot is still
+    the same, loading picks up at the last checkpoint rather than starting over.  Tables are left in place for the
+    caller, who should drop them in the same transaction that merges their contents.  (If nothing is loaded because
+    the data is unchanged, they are dropped here instead.)
+
+    :param bot: Bot instance
+    :param engine: Database engine.  Checkpoints are committed on their own connections.
+    :param url: URL of the starsystem data.
+    :param tracker: _SourceTracker
+    :param encoder: One of COPY_FORMATS.
+    :param log: Logging function.
+    :param progress: Optional function called with the total number of systems loaded so far.
+    :param local: If True, load the existing snapshot instead of downloading a new one.
+    :param counter: Optional _PrefixCounter.  Systems loaded by an earlier call can't be counted, so it is marked
+        incomplete if loading resumes partway through.
+    :return: Number of systems loaded, or None if the data is unchanged since the last refresh.
+    :raises: Whatever parsing the data raised, if it couldn't be parsed.  The tables are dropped first, since resuming
+        would only fail at the same place again.
+    """
+    base = _snapshot_base(bot, url)
+    path = _find_snapshot(base)
+    metadata = sa.MetaData()
+    staging = _temp_starsystem_table(STAGING_TABLE, unlogged=True, metadata=metadata)
+    checkpoint = sa.Table(
+        CHECKPOINT_TABLE, metadata,
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('url', sa.Text, nullable=False),
+        sa.Column('validators', postgresql.JSONB, nullable=False),
+        sa.Column('size', sa.BigInteger, nullable=False),  # Size of the snapshot, to tell if it was replaced since
+        # Uncompressed position of the next unloaded system.  (For JSON arrays, the number of elements before it.)
+        sa.Column('offset', sa.BigInteger, nullable=False),
+        sa.Column('flushed', sa.BigInteger, nullable=False),  # Number of systems loaded so far
+        sa.Column('complete', sa.Boolean, nullable=False, default=False),
+        prefixes=['UNLOGGED']
+    )
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        row = conn.execute(checkpoint.select()).first()
+
+    if (
+        row is not None and row.url == url and path is not None
+        and os.path.getsize(path) == row.size
+    ):
+        log("Resuming starsystem load from {} at byte {} ({} system(s) already loaded)", path, row.offset, row.flushed)
+        tracker.current[url] = row.validators
+    else:
+        with engine.begin() as conn:
+            conn.execute(checkpoint.delete())
+            conn.execute(staging.delete())
+        if local:
+            if path is None:
+                raise ValueError("There is no local snapshot of {}".format(url))
+            tracker.current[url] = tracker.known.get(url, {})
+        else:
+            log("Retrieving starsystem data at {}", url)
+            changed = False
+            try:
+                response = tracker.get(url, conditional=path is not None)
+                if response is not None:
+                    path = tracker.download(url, response, base)
+                    changed = tracker.changed
+            finally:
+                if not changed:
+                    # Nothing was loaded, so there is nothing to resume either.
+                    with engine.begin() as conn:
+                        metadata.drop_all(conn)
+            if not changed:
+                return None
+        offset = 0
+        if _snapshot_format(path) == 'csv':
+            with _read_snapshot(path) as f:
+                offset = len(f.readline())  # Skip the header
+        row = checkpoint.insert().values(
+            id=1, url=url, validators=tracker.current[url], size=os.path.getsize(path), offset=offset, flushed=0
+        )
+        with engine.begin() as conn:
+            conn.execute(row)
+            row = conn.execute(checkpoint.select()).first()
+    flushed = row.flushed
+    if flushed and counter is not None:
+        counter.complete = False
+    if row.complete:
+        return flushed
+
+    dedupe = _Deduplicator()
+    if flushed:
+        with engine.begin() as conn:
+            dedupe.mark(eddb_id for eddb_id, in conn.execute(sa.select(staging.c.eddb_id)))
+    copy_sql = "COPY {} ({}) FROM STDIN WITH ({})".format(STAGING_TABLE, ", ".join(COPY_COLUMNS), encoder.options)
+
+    fmt = _snapshot_format(path)
+    with _read_snapshot(path) as f:
+        if fmt == 'json':
+            # Not line-based, so skip over the elements that were already loaded instead.
+            def counted(systems):
+                nonlocal offset
+                for system in systems:
+                    offset += 1
+                    yield system
+
+            systems = _parse_systems(io.TextIOWrapper(f, encoding='utf-8'), fmt)
+            offset = 0
+            systems = itertools.islice(counted(systems), row.offset, None)
+        else:
+            fieldnames = next(csv.reader([f.readline().decode('utf-8')])) if fmt == 'csv' else None
+            # (Seeking has to decompress everything up to that point, but no longer needs the network.)
+            f.seek(row.offset)
+            offset = row.offset
+
+            def lines():
+                # Parsers only read as many lines as the current system needs, so offset is always at a boundary
+                # between systems when one has just been parsed.
+                nonlocal offset
+                for line in iter(f.readline, b''):
+                    offset += len(line)
+                    yield line.decode('utf-8')
+
+            systems = _parse_systems(lines(), fmt, fieldnames)
+        while True:
+            try:
+                batch = list(itertools.islice(systems, CHECKPOINT_THRESHOLD))
+            except Exception:
+                log("Failed to read data")
+                with engine.begin() as conn:
+                    metadata.drop_all(conn)
+                raise
+            with engine.begin() as conn:
+                cursor = conn.connection.cursor()
+                if batch:
+                    stream = _CopyStream([_encode(batch, encoder, dedupe, counter)], encoder=encoder)
+                    cursor.copy_expert(copy_sql, stream)
+                    flushed += stream.count
+                if dedupe.duplicates:
+                    # Unlike a normal load, replace duplicates right away so the checkpoint never depends on them.
+                    replaced = conn.execute(
+                        staging.delete().where(staging.c.eddb_id.in_(list(dedupe.duplicates)))
+                        .returning(staging.c.first_word, staging.c.word_ct)
+                    )
+                    if counter is not None:
+                        counter.remove(replaced)
+                    values = list(dedupe.duplicates.values())
+                    dedupe.duplicates.clear()
+                    stream = _CopyStream([_encode(values, encoder, counter=counter)], encoder=encoder)
+                    cursor.copy_expert(copy_sql, stream)
+                conn.execute(
+                    checkpoint.update().values(offset=offset, flushed=flushed, complete=len(batch) < CHECKPOINT_THRESHOLD)
+                )
+            if progress:
+                progress(flushed)
+            if len(batch) < CHECKPOINT_THRESHOLD:
+                break
+    return flushed
+
+
+def _write_prefix_stats(conn, table, counts, tolerance=1e-9):
+    """
+    Computes prefix statistics from counts of systems per prefix and writes the ones that changed to the database.
+
+    This replaces the window query over the entire starsystem table with a scan of the (much smaller) prefix table.
+    The counts must cover every system in the table, including any that are no longer published.  First words with no
+    systems at all get NULL statistics, which keeps them out of scan_for_systems().
+
+    :param conn: Database connection.
+    :param table: Name of the prefix table.
+    :param counts: Mapping of (first_word, word_ct) to a number of systems, as kept by _PrefixCounter
+    :param tolerance: Statistics that differ from what is stored by less than this aren't rewritten.
+    :return: Number of prefixes updated.
+    """
+    # Every prefix in counts has been inserted by now, but the table may have others that are no longer used.
+    words = {}
+    current = {}
+    for first_word, word_ct, ratio, cume_ratio in conn.execute(
+            "SELECT first_word, word_ct, ratio, cume_ratio FROM {}".format(table)
+    ):
+        words.setdefault(first_word, {})[word_ct] = counts.get((first_word, word_ct), 0)
+        current[first_word, word_ct] = (ratio, cume_ratio)
+
+    def changed(old, new):
+        return (old is None) != (new is None) or (new is not None and abs(old - new) > tolerance)
+
+    rows = []
+    for first_word, prefixes in words.items():
+        total = sum(prefixes.values())
+        cume = 0
+        for word_ct in sorted(prefixes):
+            if total:
+                cume += prefixes[word_ct]
+                ratio, cume_ratio = prefixes[word_ct] / total, cume / total
+            else:
+                ratio = cume_ratio = None
+            old_ratio, old_cume_ratio = current[first_word, word_ct]
+            if changed(old_ratio, ratio) or changed(old_cume_ratio, cume_ratio):
+                rows.append("\t".join((
+                    first_word.replace("\\", "\\\\"), str(word_ct),
+                    "\\N" if ratio is None else repr(ratio), "\\N" if cume_ratio is None else repr(cume_ratio)
+                )) + "\n")
+    if not rows:
+        return 0
+
+    conn.execute("""
+        CREATE TEMPORARY TABLE _temp_prefix_stats (
+            first_word TEXT, word_ct INTEGER, ratio FLOAT, cume_ratio FLOAT
+        ) ON COMMIT DROP
+    """)
+    conn.connection.cursor().copy_expert(
+        "COPY _temp_prefix_stats (first_word, word_ct, ratio, cume_ratio) FROM STDIN WITH (FORMAT text)",
+        io.StringIO("".join(rows))
+    )
+    conn.execute("""
+        UPDATE {sp} AS sp SET ratio=t.ratio, cume_ratio=t.cume_ratio
+        FROM _temp_prefix_stats AS t
+        WHERE sp.first_word=t.first_word AND sp.word_ct=t.word_ct
+    """.format(sp=table))
+    conn.execute("DROP TABLE _temp_prefix_stats")
+    return len(rows)
+
+
+def _clone_table_extras(conn, source, target, references=None):
+    """
+    Recreates the constraints, indexes and statistics targets of one table on another, which should have been created
+    with LIKE.  They are named with SHADOW_SUFFIX appended, since the originals still exist.
+
+    :param conn: Database connection.
+    :param source: Name of the existing table.
+    :param target: Name of the new table.
+    :param references: Dict of replacements for the tables that foreign keys refer to.
+    :return: List of SQL statements that restore the original names once target has been renamed to source.
+    """
+    references = references or {}
+    renames = []
+
+    rows = conn.execute(sql.text("""
+        SELECT attname, attstattarget FROM pg_attribute
+        WHERE attrelid=CAST(:t AS REGCLASS) AND attnum > 0 AND NOT attisdropped AND attstattarget > 0
+    """).bindparams(t=source))
+    for column, statistics in rows:
+        conn.execute('ALTER TABLE {} ALTER COLUMN "{}" SET STATISTICS {}'.format(target, column, statistics))
+
+    # Constraints first, since primary keys make the other indexes quicker to build.  Foreign keys go last.
+    rows = conn.execute(sql.text("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid=CAST(:t AS REGCLASS) AND contype IN('p', 'u', 'c', 'x', 'f')
+        ORDER BY contype='f', conname
+    """).bindparams(t=source))
+    for name, definition in rows:
+        definition = re.sub(
+            r'REFERENCES (?:\S+?\.)?(\S+?)\(',
+            lambda m: "REFERENCES {}(".format(references.get(m.group(1), m.group(0)[len("REFERENCES "):-1])),
+            definition
+        )
+        conn.execute("ALTER TABLE {} ADD CONSTRAINT {} {}".format(target, name + SHADOW_SUFFIX, definition))
+        renames.append("ALTER TABLE {} RENAME CONSTRAINT {} TO {}".format(source, name + SHADOW_SUFFIX, name))
+
+    rows = conn.execute(sql.text("""
+        SELECT c.relname, pg_get_indexdef(i.indexrelid)
+        FROM pg_index AS i INNER JOIN pg_class AS c ON c.oid=i.indexrelid
+        WHERE i.indrelid=CAST(:t AS REGCLASS) AND NOT EXISTS(SELECT 1 FROM pg_constraint WHERE conindid=i.indexrelid)
+    """).bindparams(t=source))
+    for name, definition in rows:
+        definition = re.sub(
+            r'^(CREATE (?:UNIQUE )?INDEX )\S+( ON (?:ONLY )?)\S+',
+            lambda m: m.group(1) + name + SHADOW_SUFFIX + m.group(2) + target,
+            definition
+        )
+        conn.execute(definition)
+        renames.append("ALTER INDEX {} RENAME TO {}".format(name + SHADOW_SUFFIX, name))
+    return renames
+
+
+def _has_outside_references(conn, tables):
+    """Returns True if any table other than the ones listed has a foreign key referring to one of them."""
+    return conn.execute(sql.text("""
+        SELECT EXISTS(
+            SELECT 1 FROM pg_constraint
+            WHERE contype='f' AND confrelid::REGCLASS::TEXT = ANY(:tables) AND NOT conrelid::REGCLASS::TEXT = ANY(:tables)
+        )
+    """).bindparams(tables=list(tables))).scalar()
+
+
+def _lock_live_tables(conn, tables, log):
+    """
+    Locks tables exclusively, for swapping them out.
+
+    While a lock request waits, it also holds up every query that comes after it, so a request that is stuck behind a
+    long-running query would stall searches for just as long.  Instead, each attempt gives up after a short while, and
+    the next one is made after giving other queries the same amount of time to get through.  See SWAP_LOCK_TIMEOUT and
+    SWAP_ATTEMPTS.
+
+    :param conn: Database connection, in the transaction that will swap the tables.
+    :param tables: Names of the tables.
+    :param log: Logging function.
+    :raises: sqlalchemy.exc.OperationalError if the tables couldn't be locked.
+    """
+    for attempt in range(1, SWAP_ATTEMPTS + 1):
+        conn.execute("SAVEPOINT _lock_live_tables")
+        try:
+            conn.execute("SET LOCAL lock_timeout = {}".format(int(SWAP_LOCK_TIMEOUT * 1000)))
+            conn.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(", ".join(tables)))
+        except sa.exc.OperationalError as ex:
+            # (Rolling back to the savepoint also undoes the lock_timeout.)
+            conn.execute("ROLLBACK TO SAVEPOINT _lock_live_tables")
+            if getattr(ex.orig, 'pgcode', None) != '55P03' or attempt == SWAP_ATTEMPTS:  # 55P03 is lock_not_available
+                log("Failed to lock the live starsystem tables")
+                raise
+            log("Live starsystem tables are busy; trying again in {} second(s)", SWAP_LOCK_TIMEOUT)
+            time.sleep(SWAP_LOCK_TIMEOUT)
+            continue
+        conn.execute("SET LOCAL lock_timeout = DEFAULT")
+        conn.execute("RELEASE SAVEPOINT _lock_live_tables")
+        return
+
+
 def refresh_database(
         bot,
         force=False, prune=True,
-        limit_one=True, callback=None, background=False,
+        limit_one=True, callback=None, background=False, conditional=True, local=False, rebuild=False,
         _lock=threading.Lock()
 ):
     """
-    Refreshes the database of starsystems.  Also rebuilds the bloom filter.
+    Refreshes the database of starsystems.  Also updates the bloom filter.
     :param bot: Bot instance
     :param force: True to force refresh regardless of age.
     :param prune: True to prune non-updated systems.  Keep True unless performance testing.
@@ -55,6 +1070,10 @@ def refresh_database(
         scheduled.
     :param background: If True and a refresh is needed, it is submitted as a background task rather than running
         immediately.
+    :param conditional: If True, the refresh stops early when the upstream data hasn't changed since the last one.
+    :param local: If True, reload the local snapshots of the starsystem data instead of downloading anything.
+    :param rebuild: If True, recompute all prefix statistics from the starsystem table rather than from the data that
+        was loaded.
     :param _lock: Internal lock against multiple calls.
     :returns: False if no refresh was needed.  Otherwise, a Future if background is True or True if a refresh occurred.
     :raises: ConcurrentOperationError if a refresh was already ongoing and limit_one is True.
@@ -67,7 +1086,10 @@ def refresh_database(
             if not release:
                 print('refresh_database call already in progress! Aborting.')
                 return False
-        result = _refresh_database(bot, force=force, prune=prune, callback=callback, background=background)
+        result = _refresh_database(
+            bot, force=force, prune=prune, callback=callback, background=background, conditional=conditional,
+            local=local, rebuild=rebuild
+        )
         if result and background and release:
             result.add_done_callback(lambda *a, **kw: _lock.release())
             release = False
@@ -78,17 +1100,24 @@ def refresh_database(
 
 
 @with_session
-def _refresh_database(bot, force=False, prune=True, callback=None, background=False, db=None):
+def _refresh_database(
+        bot, force=False, prune=True, callback=None, background=False, conditional=True, local=False, rebuild=False,
+        db=None
+):
     """
     Actual implementation of refresh_database.
 
-    Refreshes the database of starsystems.  Also rebuilds the bloom filter.
+    Refreshes the database of starsystems.  Also updates the bloom filter.
     :param bot: Bot instance
     :param force: True to force refresh
     :param prune: True to prune non-updated systems.  Keep True unless performance testing.
     :param callback: Optional function that is called as soon as the system determines a refresh is needed.
     :param background: If True and a refresh is needed, it is submitted as a background task rather than running
         immediately.
+    :param conditional: If True, the refresh stops early when the upstream data hasn't changed since the last one.
+    :param local: If True, reload the local snapshots of the starsystem data instead of downloading anything.
+    :param rebuild: If True, recompute all prefix statistics from the starsystem table rather than from the data that
+        was loaded.
     :param db: Database handle
 
     Note that this function executes some raw SQL queries (among other voodoo).  This is for performance reasons
@@ -98,16 +1127,14 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
     eddb_url = bot.config.ratbot.edsm_url or "https://eddb.io/archive/v5/systems.csv"
     chunked = bot.config.ratbot.chunked_systems
 
-    # Should really implement this, but until then
-    if chunked:
-        raise NotImplementedError("Chunked system loading is not implemented yet.")
-
     status = get_status(db)
     eddb_maxage = float(bot.config.ratbot.edsm_maxage or (7*86400))  # Once per week = 604800 seconds
+    # Finding the data unchanged counts as a refresh for the purposes of scheduling the next one.
+    last_refresh = max(filter(None, (status.starsystem_refreshed, status.starsystem_checked)), default=None)
     if not (
         force or
         not status.starsystem_refreshed or
-        (datetime.datetime.now(tz=datetime.timezone.utc) - status.starsystem_refreshed).total_seconds() > eddb_maxage
+        (datetime.datetime.now(tz=datetime.timezone.utc) - last_refresh).total_seconds() > eddb_maxage
     ):
         # No refresh needed.
         # print('not force and no refresh needed')
@@ -119,7 +1146,8 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
     if background:
         print('Scheduling background refresh of starsystem data')
         return bot.memory['ratbot']['executor'].submit(
-            _refresh_database, bot, force=True, callback=None, background=False
+            _refresh_database, bot, force=True, prune=prune, callback=None, background=False, conditional=conditional,
+            local=local, rebuild=rebuild
         )
 
     conn = db.connection()
@@ -133,10 +1161,18 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         'systems': 0,   # Time spent merging starsystems into the db.
         'prefixes': 0,  # Time spent merging starsystem prefixes into the db.
         'stats': 0,     # Time spent (re)computing system statistics
+        'index': 0,     # Time spent retrieving the starsystem chunk index.  (Chunked mode only)
         'bloom': 0,     # Time spent (re)building the system prefix bloom filter.
+        'store': 0,     # Time spent exporting the columnar starsystem snapshot.
         'optimize': 0,  # Time spent optimizing/analyzing tables.
         'misc': 0,      # Miscellaneous tasks (total time - all other stats)
         'total': 0,     # Total time spent.
+        'chunks': [],   # Per-chunk statistics, in the order of the chunk index.  (Chunked mode only)
+        'changes': {},  # Number of added, updated and unchanged systems, according to their fingerprints.
+        'unchanged': False,  # True if the refresh stopped early because upstream data had not changed.
+        'shadow': 0,    # Time spent copying and indexing shadow tables.  (Shadow table mode only)
+        'swap': None,   # Time the live tables were locked while the shadow tables replaced them.  (Ditto)
+        'prefix_stats': None,  # How prefix statistics were computed: 'streamed' from the loaded data, or 'rebuilt'.
     }
 
     def log(fmt, *args, **kwargs):
@@ -144,138 +1180,213 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
 
     overall_timer = TimedResult()
     log("Starsystem refresh started")
-    if chunked:
-        # FIXME: Needs to be reimplemented.
+
+    def finish():
+        overall_timer.stop()
+        stats['misc'] = overall_timer.seconds - sum(
+            v for v in stats.values() if isinstance(v, (int, float)) and not isinstance(v, bool)
+        )
+        stats['total'] = overall_timer.seconds
+        bot.memory['ratbot']['stats']['starsystem_refresh'] = stats
+        log("Starsystem refresh finished")
+        return True
+
+    def skip():
+        # Nothing changed upstream, so there is nothing to merge and no derived data to rebuild.
+        log("Starsystem data is unchanged; skipping the rest of the refresh")
+        db.rollback()
+        status = get_status(db)
+        status.starsystem_checked = sql.func.clock_timestamp()
+        db.add(status)
+        db.commit()
+        stats['unchanged'] = True
+        return finish()
+
+    tracker = _SourceTracker(status.starsystem_validators, conditional=conditional)
+    resumable = bot.config.ratbot.edsm_resumable
+    if resumable and chunked:
+        log("Resumable refreshes are not supported with chunked_systems; refreshing normally.")
+        resumable = False
+    sources = {}  # URLs of the snapshots being loaded, by path.  (Downloaded chunks are named by URL already.)
+    if local:
+        # Whatever snapshots we have, in whatever mode they were downloaded.
+        paths = list_snapshots(bot)
+        log("Reloading {} local snapshot(s)", len(paths))
+        # Nothing is downloaded, so the data is as current as it was after the last refresh.
+        tracker.current = dict(tracker.known)
+        sources = dict((_find_snapshot(_snapshot_base(bot, url)), url) for url in tracker.known)
+    elif chunked:
         log("Retrieving starsystem index at {}", eddb_url)
         with timed() as t:
             response = requests.get(eddb_url)
             response.raise_for_status()
             urls = list(urljoin(eddb_url, chunk["SectorName"]) for chunk in response.json())
+            bases = dict((url, _snapshot_base(bot, url)) for url in urls)
         stats['index'] += t.seconds
-        log("{} file(s) queued for starsystem refresh.  (Took {}}", len(urls), format_timestamp(t.delta))
+        log("{} file(s) queued for starsystem refresh.  (Took {})", len(urls), format_timestamp(t.delta))
+    elif not resumable:
+        # (A resumable refresh might have a load in progress, so it makes this decision itself.)
+        bases = {eddb_url: _snapshot_base(bot, eddb_url)}
+        path = _find_snapshot(bases[eddb_url])
+        with timed() as t:
+            response = tracker.get(eddb_url, conditional=path is not None)
+            if response is not None:
+                log("Retrieving starsystem data at {}", eddb_url)
+                path = tracker.download(eddb_url, response, bases[eddb_url])
+        stats['load'] += t.seconds
+        if response is None or not tracker.changed:
+            return skip()
+        paths = [path]
+        sources = {path: eddb_url}
     else:
-        urls = [eddb_url]
+        bases = {eddb_url: _snapshot_base(bot, eddb_url)}
 
-    temptable = sa.Table(
-        '_temp_new_starsystem', sa.MetaData(),
-        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
-        sa.Column('eddb_id', sa.Integer),
-        sa.Column('name_lower', sa.Text(collation="C")),
-        sa.Column('name', sa.Text(collation="C")),
-        sa.Column('first_word', sa.Text(collation="C")),
-        sa.Column('word_ct', sa.Integer),
-        sa.Column('xz', SQLPoint),
-        sa.Column('y', sa.Numeric),
-        # sa.Index('_temp_id_ix', 'eddb_id'),
-        prefixes=['TEMPORARY'], postgresql_on_commit='DROP'
-    )
-    temptable.create(conn)
+    if resumable:
+        temptable = None
+    else:
+        temptable = _temp_starsystem_table()
+        temptable.create(conn)
 
     sql_args = {
         'sp': StarsystemPrefix.__tablename__,
         's': Starsystem.__tablename__,
-        'ts': temptable.name,
+        'ts': STAGING_TABLE if resumable else temptable.name,
         'tsp': '_temp_new_prefixes'
     }
 
-    buffer = io.StringIO()  # Temporary IO buffer for COPY FROM
-    columns = ['eddb_id', 'name_lower', 'name', 'first_word', 'word_ct', 'xz', 'y']  # Columns to copy to temptable
-    getter = operator.itemgetter(*columns)
-    total_flushed = 0  # Total number of flushed items so far
-    pending_flush = 0  # Number of items waiting to flush
-
     def exec(sql, *args, **kwargs):
         try:
-            conn.execute(sql.format(*args, **kwargs, **sql_args))
+            return conn.execute(sql.format(*args, **kwargs, **sql_args))
         except Exception as ex:
             log("Query failed.")
             import traceback
             traceback.print_exc()
             raise
 
-    def flush():
-        nonlocal buffer, total_flushed, pending_flush
-        if not pending_flush:
-            return
-        log("Flushing system(s) {}-{}", total_flushed + 1, total_flushed + pending_flush)
-        buffer.seek(0)
-        cursor = conn.connection.cursor()
-        cursor.copy_from(buffer, temptable.name, sep='\t', null='', columns=columns)
-        buffer = io.StringIO()
-        # systems = []
-        total_flushed += pending_flush
-        pending_flush = 0
+    logged = 0  # Number of systems copied as of the last progress message
 
+    def progress(count):
+        nonlocal logged
+        if count - logged >= FLUSH_THRESHOLD:
+            log("Copied {} system(s)", count)
+            logged = count
 
-    with timed() as t:
-        for url in urls:
-            log("Retrieving starsystem data at {}", url)
-            try:
-                response = requests.get(url, stream=True)
-                reader = csv.DictReader(io.TextIOWrapper(response.raw))
-
-                for row in reader:
-                    # Parse and reformat system info from CSV
-                    name, word_ct = re.subn(r'\s+', ' ', row['name'].strip())
-                    name_lower = name.lower()
-                    first_word, *unused = name_lower.split(" ", 1)
-                    word_ct += 1
-                    if all((row['x'], row['y'], row['z'])):
-                        xz = "({x},{z})".format(**row)
-                        y = row['y']
-                    else:
-                        xz = y = ''
-                    system_raw = {
-                        'eddb_id': str(row['id']),
-                        'name_lower': name_lower,
-                        'name': name,
-                        'first_word': first_word,
-                        'xz': xz,
-                        'y': y,
-                        'word_ct': str(word_ct)
-                    }
-                    pending_flush += 1
-                    buffer.write("\t".join(getter(system_raw)))
-                    buffer.write("\n")
-
-                    if pending_flush >= FLUSH_THRESHOLD:
-                        flush()
-            except ValueError:
-                pass
-            except Exception as ex:
-                log("Failed to retrieve data")
-                import traceback
-                traceback.print_exc()
-            flush()
-        log("Creating index")
-        exec("CREATE INDEX ON {ts}(eddb_id)")
-    stats['load'] += t.seconds
+    def copy(stream):
+        conn.connection.cursor().copy_expert(
+            "COPY {ts} ({columns}) FROM STDIN WITH ({options})"
+            .format(columns=", ".join(COPY_COLUMNS), options=encoder.options, **sql_args),
+            stream
+        )
+        return stream.count
+
+    encoder = COPY_FORMATS[bot.config.ratbot.edsm_copy_format or COPY_FORMAT]
+    dedupe = _Deduplicator()
 
+    def failed(name):
+        # Data that didn't load mustn't be mistaken for unchanged next time.
+        tracker.discard(sources.get(name, name))
+    counter = _PrefixCounter()
     with timed() as t:
-        log("Removing possible duplicates")
-        exec("DELETE FROM {ts} WHERE eddb_id NOT IN(SELECT MAX(id) AS id FROM {ts} GROUP BY eddb_id)")
+        if resumable:
+            total_flushed = _load_resumable(
+                bot, db.get_bind(), eddb_url, tracker, encoder, log, progress, local, counter
+            )
+        elif chunked:
+            # Download and parse chunks in parallel, while COPY consumes the ones before them.
+            if local:
+                chunks = ((path, functools.partial(_load_snapshot, path)) for path in paths)
+            else:
+                chunks = ((url, functools.partial(_fetch_chunk, url, bases[url], tracker)) for url in urls)
+            workers = max(1, int(bot.config.ratbot.edsm_chunk_workers or 1))
+            batches = _pipeline(
+                _chunk_batches(chunks, log, stats['chunks'], counter, workers, encoder, dedupe, failed)
+            )
+        else:
+            # Parse in the background while COPY consumes the previous batches.
+            batches = _pipeline(_read_batches(paths, log, encoder, dedupe, counter, failed))
+        if not resumable:
+            # One COPY for everything, streamed from the batches as they arrive.
+            total_flushed = copy(_CopyStream(batches, progress, encoder))
+            # Making this a primary key (or even just a unique key) apparently affects query planner performance vs
+            # the non-existing unique key.
+            log("Creating index")
+            exec("ALTER TABLE {ts} ADD PRIMARY KEY(eddb_id)")
+        if dedupe.duplicates:
+            # Later occurrences of a system win, so replace the copies that were already loaded.
+            log("Replacing {} duplicate system(s)", len(dedupe.duplicates))
+            counter.remove(exec(
+                "DELETE FROM {ts} WHERE eddb_id IN({ids}) RETURNING first_word, word_ct",
+                ids=", ".join(map(str, dedupe.duplicates))
+            ))
+            copy(_CopyStream([_encode(list(dedupe.duplicates.values()), encoder, counter=counter)], encoder=encoder))
+    stats['load'] += t.seconds
+    if total_flushed is None:
+        return skip()
+    stats['ingest'] = {'systems': total_flushed, 'rate': total_flushed / t.seconds if t.seconds else 0}
+    log("Loaded {} system(s) at {:.0f} systems/second", total_flushed, stats['ingest']['rate'])
+    if not local and not tracker.changed:
+        return skip()
 
-        # No need for the temporary 'id' column at this point.
-        exec("ALTER TABLE {ts} DROP id CASCADE");
-        # Making this a primary key (or even just a unique key) apparently affects query planner performance vs the
-        # non-existing unique key.
-        exec("ALTER TABLE {ts} ADD PRIMARY KEY(eddb_id)");
+    if counter.complete and not rebuild:
+        with timed() as t:
+            # Systems that are no longer published stay in the table, so they still count towards prefix statistics.
+            # (This has to happen while every published system is still in the temporary table.)
+            log("Counting systems that are no longer published")
+            for first_word, word_ct, count in exec("""
+                SELECT s.first_word, s.word_ct, COUNT(*) FROM {s} AS s
+                WHERE NOT EXISTS(SELECT 1 FROM {ts} AS t WHERE t.eddb_id=s.eddb_id)
+                GROUP BY s.first_word, s.word_ct
+            """):
+                counter.counts[first_word, word_ct] += count
+        stats['stats'] += t.seconds
 
+    with timed() as t:
+        unchanged = 0
         if prune:
             log("Removing non-updates to existing systems")
-            # If a starsystem has been updated, at least one of 'name', 'xz' or 'y' are guaranteed to have changed.
-            # (A change that effects word_ct would effect name as well, for instance.)
-            # Delete any temporary systems that exist in the real table with matching attributes.
-            exec("""
+            # If a starsystem has been updated, at least one of 'name', 'xz' or 'y' are guaranteed to have changed,
+            # and so has its fingerprint.  (A change that effects word_ct would effect name as well, for instance.)
+            # Delete any temporary systems that exist in the real table with a matching fingerprint.
+            unchanged = exec("""
                 DELETE FROM {ts} AS t USING {s} AS s
-                WHERE s.eddb_id=t.eddb_id
-                AND ROW(s.name, s.y) IS NOT DISTINCT FROM ROW(t.name, t.y)
-                AND ((s.xz IS NULL)=(t.xz IS NULL)) AND (s.xz~=t.xz OR s.xz IS NULL)
-            """)
+                WHERE s.eddb_id=t.eddb_id AND s.fingerprint=t.fingerprint
+            """).rowcount
         else:
             log("Skipping non-update removal phase")
+
+        added, updated, remaining = exec("""
+            SELECT
+                COUNT(*) FILTER (WHERE s.eddb_id IS NULL),
+                COUNT(*) FILTER (WHERE s.eddb_id IS NOT NULL AND s.fingerprint IS DISTINCT FROM t.fingerprint),
+                COUNT(*) FILTER (WHERE s.fingerprint=t.fingerprint)
+            FROM {ts} AS t LEFT JOIN {s} AS s ON s.eddb_id=t.eddb_id
+        """).first()
+        stats['changes'] = {'added': added, 'updated': updated, 'unchanged': unchanged + remaining}
+        log("{added} new, {updated} updated and {unchanged} unchanged system(s)", **stats['changes'])
     stats['prune'] += t.seconds
 
+    live = {'s': sql_args['s'], 'sp': sql_args['sp']}
+    shadow = bot.config.ratbot.edsm_shadow_tables
+    if shadow and _has_outside_references(conn, live.values()):
+        log("Other tables refer to the starsystem tables, so they can't be swapped out; refreshing in place.")
+        shadow = False
+    if shadow:
+        with timed() as t:
+            # Everything from here on happens to a copy of the tables, which replaces the originals at the end.
+            # Systems that are about to be replaced aren't copied, so that they are simply inserted later.
+            log("Copying starsystems to shadow tables")
+            sql_args.update(
+                s=live['s'] + SHADOW_SUFFIX, sp=live['sp'] + SHADOW_SUFFIX, live_s=live['s'], live_sp=live['sp']
+            )
+            exec("CREATE TABLE {sp} (LIKE {live_sp} INCLUDING DEFAULTS)")
+            exec("INSERT INTO {sp} SELECT * FROM {live_sp}")
+            exec("CREATE TABLE {s} (LIKE {live_s} INCLUDING DEFAULTS)")
+            exec("""
+                INSERT INTO {s}
+                SELECT s.* FROM {live_s} AS s WHERE NOT EXISTS(SELECT 1 FROM {ts} AS t WHERE t.eddb_id=s.eddb_id)
+            """)
+        stats['shadow'] += t.seconds
+
     with timed() as t:
         log("Building list of distinct prefixes")
         # Create list of unique prefixes in this batch
@@ -284,6 +1395,12 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
             AS SELECT DISTINCT first_word, word_ct FROM {ts}
         """)
 
+        # Note which first words are entirely new, so they can be added to the bloom filter without rebuilding it.
+        new_words = list(row[0] for row in conn.execute("""
+            SELECT DISTINCT t.first_word FROM {tsp} AS t
+            WHERE NOT EXISTS(SELECT 1 FROM {sp} AS sp WHERE sp.first_word=t.first_word)
+        """.format(**sql_args)))
+
         # Insert new prefixes
         exec("""
             INSERT INTO {sp} (first_word, word_ct)
@@ -299,15 +1416,17 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         log("Updating existing systems.")
         exec("""
             UPDATE {s} AS s
-            SET name_lower=t.name_lower, name=t.name, first_word=t.first_word, word_ct=t.word_ct, xz=t.xz, y=t.y
+            SET
+                name_lower=t.name_lower, name=t.name, first_word=t.first_word, word_ct=t.word_ct, xz=t.xz, y=t.y,
+                fingerprint=t.fingerprint
             FROM {ts} AS t
             WHERE s.eddb_id=t.eddb_id
         """)
 
         log("Inserting new systems.")
         exec("""
-            INSERT INTO {s} (eddb_id, name_lower, name, first_word, word_ct, xz, y)
-            SELECT t.eddb_id, t.name_lower, t.name, t.first_word, t.word_ct, t.xz, t.y
+            INSERT INTO {s} (eddb_id, name_lower, name, first_word, word_ct, xz, y, fingerprint)
+            SELECT t.eddb_id, t.name_lower, t.name, t.first_word, t.word_ct, t.xz, t.y, t.fingerprint
             FROM {ts} AS t
             LEFT JOIN {s} AS s ON s.eddb_id=t.eddb_id
             WHERE s.eddb_id IS NULL
@@ -315,29 +1434,47 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
 
     stats['systems'] += t.seconds
 
+    if shadow:
+        with timed() as t:
+            # Indexes are far quicker to build all at once than to maintain during the inserts.
+            log("Indexing shadow tables")
+            renames = _clone_table_extras(conn, live['sp'], sql_args['sp'])
+            renames += _clone_table_extras(conn, live['s'], sql_args['s'], {live['sp']: sql_args['sp']})
+        stats['shadow'] += t.seconds
+
     with timed() as t:
-        log('Computing prefix statistics')
-        exec("""
-            UPDATE {sp} SET ratio=t.ratio, cume_ratio=t.cume_ratio
-            FROM (
-                SELECT
-                    t.first_word, t.word_ct, ct/(SUM(ct) OVER w) AS ratio,
-                    (SUM(ct) OVER p)/(SUM(ct) OVER w) AS cume_ratio
+        if rebuild or not counter.complete:
+            if not rebuild:
+                log("Not every system was counted while loading, so prefix statistics have to be recomputed")
+            log('Computing prefix statistics')
+            stats['prefix_stats'] = 'rebuilt'
+            # A full rebuild covers every prefix; otherwise, only those sharing a first word with a loaded system.
+            exec("""
+                UPDATE {sp} SET ratio=t.ratio, cume_ratio=t.cume_ratio
                 FROM (
-                    SELECT sp.*, COUNT(s.eddb_id) AS ct
-                    FROM
-                        {sp} AS sp
-                        LEFT JOIN {s} AS s USING (first_word, word_ct)
-                    WHERE sp.first_word IN(SELECT first_word FROM {tsp})
-                    GROUP BY sp.first_word, sp.word_ct
-                    HAVING COUNT(*) > 0
+                    SELECT
+                        t.first_word, t.word_ct, ct/(SUM(ct) OVER w) AS ratio,
+                        (SUM(ct) OVER p)/(SUM(ct) OVER w) AS cume_ratio
+                    FROM (
+                        SELECT sp.*, COUNT(s.eddb_id) AS ct
+                        FROM
+                            {sp} AS sp
+                            LEFT JOIN {s} AS s USING (first_word, word_ct)
+                        WHERE {everything} OR sp.first_word IN(SELECT first_word FROM {tsp})
+                        GROUP BY sp.first_word, sp.word_ct
+                        HAVING COUNT(*) > 0
+                    ) AS t
+                    WINDOW
+                    w AS (PARTITION BY t.first_word ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING),
+                    p AS (PARTITION BY t.first_word ORDER BY t.word_ct ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
                 ) AS t
-                WINDOW
-                w AS (PARTITION BY t.first_word ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING),
-                p AS (PARTITION BY t.first_word ORDER BY t.word_ct ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
-            ) AS t
-            WHERE {sp}.first_word=t.first_word AND {sp}.word_ct=t.word_ct
-        """)
+                WHERE {sp}.first_word=t.first_word AND {sp}.word_ct=t.word_ct
+            """, everything='TRUE' if rebuild else 'FALSE')
+        else:
+            log('Writing prefix statistics')
+            stats['prefix_stats'] = 'streamed'
+            updated = _write_prefix_stats(conn, sql_args['sp'], counter.counts)
+            log("Updated statistics of {} prefix(es)", updated)
     stats['stats'] += t.seconds
     with timed() as t:
         log("Analyzing tables")
@@ -345,11 +1482,29 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         exec("ANALYZE {s}")
     stats['optimize'] += t.seconds
 
+    if resumable:
+        # Goes away in the same transaction that merged it, so an interrupted merge can still be resumed.
+        exec("DROP TABLE {ts}, {checkpoint}", checkpoint=CHECKPOINT_TABLE)
+
+    if shadow:
+        log("Swapping in shadow tables")
+        _lock_live_tables(conn, live.values(), log)
+        # From here until the commit, the live tables are locked.
+        swap_timer = TimedResult()
+        for table in live.values():
+            exec("ALTER TABLE {} RENAME TO {}", table, table + "__old")
+        for table in live.values():
+            exec("ALTER TABLE {} RENAME TO {}", table + SHADOW_SUFFIX, table)
+        exec("DROP TABLE {}, {}", *(table + "__old" for table in live.values()))
+        for statement in renames:
+            exec(statement)
+
     log("Starsystem database update complete")
     # Update refresh time
     try:
         status = get_status(db)
         status.starsystem_refreshed = sql.func.clock_timestamp()
+        status.starsystem_validators = tracker.current
         db.add(status)
         db.commit()
     except Exception as ex:
@@ -357,24 +1512,99 @@ def _refresh_database(bot, force=False, prune=True, callback=None, background=Fa
         traceback.print_exc()
         raise
     log("Starsystem database update committed")
+    get_system_cache(bot).flush()
+    if shadow:
+        stats['swap'] = swap_timer.stop()
+        log("Live starsystem tables were locked for {:.3f} seconds", stats['swap'])
+
+    if not local:
+        # Forget snapshots of chunks that are no longer part of the data, and remember the order of the rest.
+        current = list(filter(None, (_find_snapshot(base) for base in bases.values())))
+        for path in list_snapshots(bot):
+            if path not in current:
+                os.remove(path)
+        if current:
+            _write_snapshot_order(bot, current)
+
+    log("Reloading prefix table")
+    refresh_prefixes(bot)
 
     with timed() as t:
-        log("Rebuilding bloom filter")
-        refresh_bloom(bot)
+        log("Adding {} new prefix(es) to bloom filter", len(new_words))
+        if not update_bloom(bot, new_words):
+            log("Bloom filter was rebuilt")
     stats['bloom'] += t.seconds
 
-    overall_timer.stop()
-    stats['misc'] = overall_timer.seconds - sum(stats.values())
-    stats['total'] = overall_timer.seconds
-    bot.memory['ratbot']['stats']['starsystem_refresh'] = stats
-    log("Starsystem refresh finished")
-    return True
+    if bot.config.ratbot.system_store:
+        with timed() as t:
+            log("Exporting columnar starsystem snapshot")
+            refresh_system_store(bot)
+        stats['store'] += t.seconds
+
+    # Everything scan_for_systems() relies on is current now, so forget results based on the old data.
+    get_scan_cache(bot).clear()
+
+    return finish()
+
+
+def _status_timestamp(db):
+    """Returns the time of the last starsystem refresh as seconds since the epoch, or 0 if it has never happened."""
+    status = get_status(db)
+    if status is None or status.starsystem_refreshed is None:
+        return 0.0
+    return status.starsystem_refreshed.timestamp()
+
+
+@with_session
+def load_bloom(bot, db):
+    """
+    Loads the bloom filter from disk if it is current, rebuilding it otherwise.
+
+    The persisted filter is only considered current if it was written after the most recent starsystem refresh (that
+    is, its timestamp matches Status.starsystem_refreshed).
+
+    :param bot: Bot storing the bloom filter
+    :param db: Database handle
+    :return: Bloom filter.
+    """
+    bloom_class = NumpyBloomFilter if NumpyBloomFilter.available else BloomFilter
+    filename = _workdir_path(bot, BLOOM_FILENAME)
+    with timed() as t:
+        try:
+            bloom, header = bloom_class.load(filename)
+        except (OSError, ValueError) as ex:
+            print("Not using persisted bloom filter: {}".format(ex))
+            bloom = header = None
+    if bloom is None or header['timestamp'] != _status_timestamp(db):
+        return refresh_bloom(bot)
+    bot.memory['ratbot']['starsystem_bloom'] = bloom
+    bot.memory['ratbot']['stats']['starsystem_bloom'] = {
+        'entries': header['entries'], 'time': t.seconds, 'hash_set': header['hash_set']
+    }
+    return bloom
+
+
+def _save_bloom(bot, db, bloom):
+    """
+    Persists the bloom filter to the work directory, stamped with the current starsystem refresh time.
+
+    Failures are logged but otherwise ignored: the worst case is a rebuild on the next startup.
+    """
+    stats = bot.memory['ratbot']['stats']['starsystem_bloom']
+    try:
+        filename = _workdir_path(bot, BLOOM_FILENAME)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        bloom.save(filename, stats['hash_set'], entries=stats['entries'], timestamp=_status_timestamp(db))
+    except OSError:
+        print("Failed to persist bloom filter.")
+        import traceback
+        traceback.print_exc()
 
 
 @with_session
 def refresh_bloom(bot, db):
     """
-    Refreshes the bloom filter.
+    Refreshes the bloom filter, and persists it to the work directory.
 
     :param bot: Bot storing the bloom filter
     :param db: Database handle
@@ -382,20 +1612,285 @@ def refresh_bloom(bot, db):
     """
     # Get filter planning statistics
     count = db.query(sql.func.count(sql.distinct(StarsystemPrefix.first_word))).scalar() or 0
-    bits, hashes = BloomFilter.suggest_size_and_hashes(rate=0.01, count=max(32, count), max_hashes=10)
-    bloom = BloomFilter(bits, BloomFilter.extend_hashes(hashes))
+    bits, hashes, hash_set = BloomFilter.suggest_size_and_hash_set(rate=0.01, count=max(32, count), max_hashes=10)
+    # Prefer the vectorized engine when numpy is around; both produce identical filters.
+    bloom_class = NumpyBloomFilter if NumpyBloomFilter.available else BloomFilter
+    bloom = bloom_class(bits, HASH_SETS[hash_set](hashes))
     with timed() as t:
-        bloom.update(x[0] for x in db.query(StarsystemPrefix.first_word).distinct())
+        bloom.update_many(x[0] for x in db.query(StarsystemPrefix.first_word).distinct())
     # print(
     #     "Recomputing bloom filter took {} seconds.  {}/{} bits, {} hashes, {} false positive chance"
     #     .format(end-start, bloom.setbits, bloom.bits, hashes, bloom.false_positive_chance())
     # )
     bot.memory['ratbot']['starsystem_bloom'] = bloom
-    bot.memory['ratbot']['stats']['starsystem_bloom'] = {'entries': count, 'time': t.seconds}
+    bot.memory['ratbot']['stats']['starsystem_bloom'] = {'entries': count, 'time': t.seconds, 'hash_set': hash_set}
+    _save_bloom(bot, db, bloom)
     return bloom
 
 
-def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
+@with_session
+def update_bloom(bot, words, db):
+    """
+    Adds new prefixes to the live bloom filter, rather than rebuilding it from scratch.
+
+    If there is no live filter, or adding the words pushes its false positive chance past the configured
+    bloom_max_fp, the filter is rebuilt with refresh_bloom() instead.
+
+    :param bot: Bot storing the bloom filter
+    :param words: Sequence of first words that were not previously in the database.
+    :param db: Database handle
+    :return: True if the filter was updated in place, False if it was rebuilt.
+    """
+    bloom = bot.memory['ratbot'].get('starsystem_bloom')
+    stats = bot.memory['ratbot']['stats'].get('starsystem_bloom')
+    if bloom is None or not stats:
+        refresh_bloom(bot)
+        return False
+
+    max_fp = float(bot.config.ratbot.bloom_max_fp or 0.02)
+    with timed() as t:
+        bloom.update_many(words)
+    stats['entries'] += len(words)
+    if bloom.false_positive_chance() > max_fp:
+        refresh_bloom(bot)
+        return False
+    stats['time'] = t.seconds
+    _save_bloom(bot, db, bloom)
+    return True
+
+
+@with_session
+def refresh_prefixes(bot, db):
+    """
+    Loads the in-memory copy of the StarsystemPrefix table.
+
+    The table maps each first_word to a tuple of (word_ct, cume_ratio) pairs sorted by word_ct.  It is built in full
+    and then swapped in as a whole, so readers always see either the old or the new table.
+
+    :param bot: Bot storing the prefix table
+    :param db: Database handle
+    :return: New prefix table.
+    """
+    with timed() as t:
+        table = {}
+        query = (
+            db.query(StarsystemPrefix.first_word, StarsystemPrefix.word_ct, StarsystemPrefix.cume_ratio)
+            .order_by(StarsystemPrefix.first_word, StarsystemPrefix.word_ct)
+        )
+        for first_word, word_ct, cume_ratio in query:
+            table.setdefault(first_word, []).append((word_ct, cume_ratio))
+        table = dict((first_word, tuple(prefixes)) for first_word, prefixes in table.items())
+    bot.memory['ratbot']['starsystem_prefixes'] = table
+    bot.memory['ratbot']['stats']['starsystem_prefixes'] = {'entries': len(table), 'time': t.seconds}
+    return table
+
+
+@with_session
+def load_system_store(bot, db):
+    """
+    Memory-maps the columnar starsystem snapshot from disk if it is current.
+
+    If the snapshot is missing or stale, a rebuild is scheduled in the background; until it finishes, system detection
+    and !complete use the database as usual, and !search ranks every name by distance.
+
+    :param bot: Bot storing the snapshot
+    :param db: Database handle
+    :return: System store, or None if it is not available yet.
+    """
+    with timed() as t:
+        try:
+            store, header = SystemStore.load(_workdir_path(bot, SYSTEM_STORE_FILENAME))
+        except (OSError, ValueError) as ex:
+            print("Not using persisted system store: {}".format(ex))
+            store = header = None
+    if store is None or header['timestamp'] != _status_timestamp(db):
+        print("Scheduling background export of system store")
+        bot.memory['ratbot']['executor'].submit(refresh_system_store, bot)
+        return None
+    bot.memory['ratbot']['starsystem_store'] = store
+    bot.memory['ratbot']['stats']['starsystem_store'] = {'entries': len(store), 'time': t.seconds}
+    return store
+
+
+@with_session
+def refresh_system_store(bot, db):
+    """
+    Exports the starsystem table to a new columnar snapshot, and swaps it in.
+
+    :param bot: Bot storing the snapshot
+    :param db: Database handle
+    :return: New system store.
+    """
+    filename = _workdir_path(bot, SYSTEM_STORE_FILENAME)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with timed() as t:
+        query = (
+            db.query(Starsystem.eddb_id, Starsystem.name, Starsystem.xz, Starsystem.y)
+            .order_by(Starsystem.name_lower)
+            .execution_options(stream_results=True)
+            .yield_per(FLUSH_THRESHOLD)
+        )
+        SystemStore.write(
+            filename,
+            (
+                (eddb_id, name, None if xz is None or y is None else (xz.x, y, xz.z))
+                for eddb_id, name, xz, y in query
+            ),
+            timestamp=_status_timestamp(db)
+        )
+        store, header = SystemStore.load(filename)
+    bot.memory['ratbot']['starsystem_store'] = store
+    bot.memory['ratbot']['stats']['starsystem_store'] = {'entries': len(store), 'time': t.seconds}
+    return store
+
+
+def get_scan_cache(bot):
+    """
+    Returns the cache of scan_for_systems() results, creating it if needed.
+
+    :param bot: Bot storing the cache
+    """
+    return bot.memory['ratbot'].setdefault('starsystem_scan_cache', LRUCache(SCAN_CACHE_SIZE))
+
+
+class SystemSnapshot(collections.namedtuple('SystemSnapshot', 'eddb_id name_lower name xz y')):
+    """
+    Immutable copy of a Starsystem's columns, as returned by lookup_system().  Unlike a Starsystem, it isn't tied to
+    the session it was loaded in, so it can be cached and shared between commands.
+    """
+    __slots__ = ()
+
+    x = property(lambda self: None if self.xz is None else self.xz.x)
+    z = property(lambda self: None if self.xz is None else self.xz.z)
+
+    @property
+    def has_coordinates(self):
+        return self.xz is not None and self.y is not None
+
+    def distance(self, other):
+        """Returns the distance to another system or landmark, or None if either has unknown coordinates."""
+        if not self.has_coordinates or not other.has_coordinates:
+            return None
+        return math.sqrt((self.x - other.x)**2 + (self.y - other.y)**2 + (self.z - other.z)**2)
+
+    def nearest_landmark(self, db, with_distance=False):
+        """Returns the nearest Landmark, as with Starsystem.nearest_landmark()"""
+        return Starsystem.nearest_landmark(self, db, with_distance)
+
+
+class SystemCache:
+    """
+    Cache of lookup_system() results: recently found systems, and recently missing names.
+
+    A refresh replaces the data that entries were loaded from, so flush() discards all of them at once.  Lookups that
+    were already running when the cache was flushed don't add their (possibly outdated) results afterwards.
+    """
+    def __init__(self, maxsize=SYSTEM_CACHE_SIZE, negative_maxsize=SYSTEM_NEGATIVE_CACHE_SIZE):
+        """
+        :param maxsize: Maximum number of systems to keep.
+        :param negative_maxsize: Maximum number of missing names to keep.
+        """
+        self.found = LRUCache(maxsize)
+        self.missing = LRUCache(negative_maxsize)
+        self.hits = self.negative_hits = self.misses = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, name_lower):
+        """
+        Looks up a name.
+
+        :param name_lower: Lowercased name.
+        :return: A tuple of (found, system): found is False if the name isn't cached, and system is a SystemSnapshot or
+            None if the name is known to be missing.
+        """
+        system = self.found.get(name_lower)
+        if system is not None:
+            with self._lock:
+                self.hits += 1
+            return True, system
+        if self.missing.get(name_lower) is not None:
+            with self._lock:
+                self.negative_hits += 1
+            return True, None
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def put(self, name_lower, system, generation):
+        """
+        Caches the result of a lookup, unless the cache was flushed since it started.
+
+        :param name_lower: Lowercased name.
+        :param system: SystemSnapshot, or None if the name is missing.
+        :param generation: Value of the generation attribute when the lookup started.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            if system is None:
+                self.missing.put(name_lower, True)
+            else:
+                self.found.put(name_lower, system)
+
+    def flush(self):
+        """
+        Removes all entries.  Hit and miss counts are kept.
+        """
+        with self._lock:
+            self.generation += 1
+            self.found.clear()
+            self.missing.clear()
+
+    def info(self):
+        """
+        Returns a dict of cache statistics: hits, negative_hits, misses, size, maxsize, negative_size and
+        negative_maxsize.
+        """
+        return {
+            'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+            'size': len(self.found), 'maxsize': self.found.maxsize,
+            'negative_size': len(self.missing), 'negative_maxsize': self.missing.maxsize,
+        }
+
+
+def get_system_cache(bot):
+    """
+    Returns the cache of lookup_system() results, creating it if needed.
+
+    :param bot: Bot storing the cache
+    """
+    return bot.memory['ratbot'].setdefault('starsystem_lookup_cache', SystemCache())
+
+
+def lookup_system(bot, db, name):
+    """
+    Looks up a starsystem by name, caching the result (or its absence) until the next refresh.
+
+    :param bot: Bot storing the cache
+    :param db: Database session, used on a cache miss.
+    :param name: Name of the system, in any case.
+    :return: A SystemSnapshot, or None if there is no such system.
+    """
+    if name is None:
+        return None
+    name_lower = name.lower()
+    cache = get_system_cache(bot)
+    found, system = cache.get(name_lower)
+    if found:
+        return system
+    generation = cache.generation
+    row = (
+        db.query(Starsystem.eddb_id, Starsystem.name_lower, Starsystem.name, Starsystem.xz, Starsystem.y)
+        .filter(Starsystem.name_lower == name_lower)
+        .first()
+    )
+    system = SystemSnapshot(*row) if row else None
+    cache.put(name_lower, system, generation)
+    return system
+
+
+def scan_for_systems(bot, line, min_ratio=0.05, min_length=6, stats=None):
     """
     Scans for system names that might occur in the line of text.
 
@@ -403,8 +1898,12 @@ def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
     :param line: Line of text
     :param min_ratio: Minimum cumulative ratio to consider an acceptable match.
     :param min_length: Minimum length of the word matched on a single-word match.
+    :param stats: If not None, a dict that will be updated with scan statistics: 'candidates' (number of candidate
+        names checked), 'queries' (number of database queries made) and 'cached' (True if the result was cached).
     :return: Set of matched systems.
 
+    Results are cached by the normalized line (see get_scan_cache()) until the next starsystem refresh.
+
     min_ratio explained:
 
     There's one StarsystemPrefix for each distinct combination of (first word, word count).  Each prefix has a
@@ -427,6 +1926,23 @@ def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
     # like a hyphen in a system name (since there won't be a space in the right place.)
     words = list(filter(None, re.split(r'\W*\s+\W*', ' ' + line.lower() + ' ')))
 
+    # Lines that only differ in case, spacing or punctuation between words always produce the same result.
+    cache = get_scan_cache(bot)
+    key = (" ".join(words), min_ratio, min_length)
+    result = cache.get(key)
+    if result is None:
+        result = frozenset(_scan_words(bot, words, min_ratio, min_length, stats))
+        cache.put(key, result)
+    elif stats is not None:
+        stats.update(candidates=0, queries=0, cached=True)
+    return set(result)
+
+
+def _scan_words(bot, words, min_ratio, min_length, stats):
+    """
+    Implementation of scan_for_systems() for a line that has already been split into words.
+    """
+
     # Check for words that are in the bloom filter.  Make a note of their location in the word list.
     bloom = bot.memory['ratbot']['starsystem_bloom']
     candidates = {}
@@ -436,33 +1952,394 @@ def scan_for_systems(bot, line, min_ratio=0.05, min_length=6):
         elif word in bloom:
             candidates[word] = [ix]
 
+    if stats is not None:
+        stats.update(candidates=0, queries=0, cached=False)
+
     # No candidates; bail.
     if not candidates:
         return set()
 
-    # Still here, so find prefixes in the database
-    db = get_session(bot)
+    # Still here, so find matching prefixes in the in-memory prefix table.
+    prefixes = bot.memory['ratbot'].get('starsystem_prefixes')
+    if prefixes is None:
+        prefixes = refresh_prefixes(bot)
+    matches = list(
+        (first_word, word_ct)
+        for first_word in candidates
+        for word_ct, cume_ratio in prefixes.get(first_word, ())
+        if cume_ratio is not None and cume_ratio >= min_ratio and (word_ct > 1 or len(first_word) >= min_length)
+    )
+
+    # Build every possible name these prefixes could match, in order.
+    checks = []
+    for first_word, word_ct in matches:
+        # Look through matching words.
+        for ix in candidates[first_word]:
+            # Bail if there's not enough room for the rest of this prefix.
+            # (e.g. last word of the line was "MCC", with no room for a possible "811")
+            endix = ix + word_ct
+            if endix > len(words):
+                break
+            checks.append((first_word, " ".join(words[ix:endix])))
+    if stats is not None:
+        stats['candidates'] = len(checks)
+    if not checks:
+        return set()
+
+    # Resolve all of them at once -- from the system store if it's loaded, or in one query otherwise.
+    store = bot.memory['ratbot'].get('starsystem_store')
+    if store is not None:
+        positions = ((check, store.find(check)) for first_word, check in checks)
+        names = dict((check, store.name(ix)) for check, ix in positions if ix is not None)
+    else:
+        db = get_session(bot)
+        try:
+            names = dict(
+                db.query(Starsystem.name_lower, Starsystem.name)
+                .filter(Starsystem.name_lower.in_(set(check for first_word, check in checks)))
+            )
+        finally:
+            db.rollback()
+        if stats is not None:
+            stats['queries'] += 1
+
+    # Keep the longest match for each prefix.
     results = {}
+    for first_word, check in checks:
+        name = names.get(check)
+        if not name or (first_word in results and len(results[first_word]) > len(name)):
+            continue
+        results[first_word] = name
+    return set(results.values())
+
+
+def search_systems(db, name, max_distance=10, max_results=4, prefilter=False, stats=None):
+    """
+    Finds the starsystems with names closest to the given one, by Levenshtein distance.
+
+    With prefilter, candidates are narrowed down with a trigram index on name_lower first.  A single edit removes at most 3 of a
+    name's trigrams, so any system too dissimilar to be a candidate is known to be at least a certain distance away.
+    If every match found among the candidates is closer than that, they are exactly the matches that comparing against
+    every system would find.  Otherwise, lower similarity limits are tried, and as a last resort every system of a
+    length that could still beat the matches found so far is compared.
+
+    :param db: Database session
+    :param name: Lowercased name to search for.
+    :param max_distance: Maximum distance of a match.
+    :param max_results: Maximum number of matches.
+    :param prefilter: If True, try the trigram index first.  This needs the pg_trgm extension and the index described
+        in README.md, and has only been measured to win on smaller databases; see benchmark_search().
+    :param stats: Optional dict that receives statistics: 'limit' is the similarity limit whose candidates were
+        conclusive (or None if it came down to comparing every system), and 'queries' is the number of queries made
+        against the starsystem table.
+    :return: List of (Starsystem, distance) rows, closest first.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(limit=None, queries=0)
+
+    def query(cutoff):
+        expr = sql.func.levenshtein_less_equal(Starsystem.name_lower, name, cutoff)
+        stats['queries'] += 1
+        return db.query(Starsystem, expr.label("distance")).filter(expr <= cutoff).order_by(expr.asc())
+
+    cutoff = max_distance  # Distance that a system must not exceed to make the list.
+    if prefilter:
+        trigrams = db.query(sql.func.coalesce(sql.func.array_length(sql.func.show_trgm(name), 1), 0)).scalar()
+        for limit in SEARCH_SIMILARITY_LIMITS:
+            # A system with d edits shares at least (trigrams - 3d) trigrams with the name, and has at most 3d of its
+            # own that the name doesn't.  So a system with a similarity below limit is more than this far away:
+            bound = trigrams * (1 - limit) / (3 * (1 + limit))
+            if bound < 1:
+                continue
+            db.query(sql.func.set_config('pg_trgm.similarity_threshold', str(limit), True)).scalar()
+            result = query(cutoff).filter(Starsystem.name_lower.op('%')(name))[:max_results]
+            if len(result) == max_results:
+                # Nothing further than the worst of these can make the list.
+                cutoff = min(cutoff, result[-1].distance)
+            if cutoff <= bound:
+                stats['limit'] = limit
+                return result
+
+    # Still here, so compare every system.  Each insertion or deletion changes the length by 1, which rules out
+    # many of them cheaply.
+    return (
+        query(cutoff)
+        .filter(sql.func.length(Starsystem.name_lower).between(len(name) - cutoff, len(name) + cutoff))
+    )[:max_results]
+
+
+def complete_system_name(bot, prefix, limit=10, db=None):
+    """
+    Finds the starsystems with names starting with the given prefix, from the system store if it's loaded.
+
+    :param bot: Bot instance
+    :param prefix: Lowercased prefix.
+    :param limit: Maximum number of names to return.
+    :param db: Database session.  Only used if the system store isn't loaded.
+    :return: A tuple of (names, total), where names is a list of up to limit names in order and total is the number of
+        names starting with prefix.  Without the system store, total is None if there are more than limit.
+    """
+    store = bot.memory['ratbot'].get('starsystem_store')
+    if store is not None:
+        start, end = store.prefix_range(prefix)
+        return [store.name(ix) for ix in range(start, min(end, start + limit))], end - start
+    names = [
+        row[0] for row in
+        db.query(Starsystem.name)
+        .filter(Starsystem.name_lower.startswith(prefix, autoescape=True))
+        .order_by(Starsystem.name_lower)
+        .limit(limit + 1)
+    ]
+    return names[:limit], (len(names) if len(names) <= limit else None)
+
+
+def search_prefix(bot, name, max_distance=10, max_results=4, max_candidates=PREFIX_SEARCH_CANDIDATES):
+    """
+    Finds the starsystems closest to the given name among those whose names start with it, from the system store.
+
+    A name that starts with the search is exactly as far from it as the number of characters it adds, so these are
+    ranked without computing any Levenshtein distances.  Names that don't start with the search may still be closer,
+    so these are only the closest of all names if they are within 1; see search_names().
+
+    :param bot: Bot instance
+    :param name: Lowercased name to search for.
+    :param max_distance: Maximum distance of a match.
+    :param max_results: Maximum number of matches.
+    :param max_candidates: If more names than this start with name, give up.
+    :return: List of (name, distance) tuples, closest first, or None if the system store isn't loaded, no names start
+        with name or too many do.
+    """
+    store = bot.memory['ratbot'].get('starsystem_store')
+    if store is None:
+        return None
+    start, end = store.prefix_range(name)
+    if not start < end <= start + max_candidates:
+        return None
+    keys = ((store.key(ix), ix) for ix in range(start, end))
+    candidates = sorted((len(key) - len(name), key, ix) for key, ix in keys)
+    result = [(store.name(ix), distance) for distance, key, ix in candidates[:max_results] if distance <= max_distance]
+    return result or None
+
+
+def search_names(bot, name, max_distance=10, max_results=4, db=None):
+    """
+    Finds the starsystems with names closest to the given one, by Levenshtein distance, for !search.
+
+    Names that start with the search are ranked from the system store first.  Any other name is at least 1 away, so if
+    enough of those are within 1, nothing can beat them.  Otherwise they narrow down the full search by
+    search_systems(), which only uses its trigram prefilter if the search_prefilter option is set.
+
+    :param bot: Bot instance
+    :param name: Lowercased name to search for.
+    :param max_distance: Maximum distance of a match.
+    :param max_results: Maximum number of matches.
+    :param db: Database session.
+    :return: List of (name, distance) tuples, closest first.
+    """
+    result = search_prefix(bot, name, max_distance=max_distance, max_results=max_results) or []
+    if len(result) == max_results:
+        if result[-1][1] <= 1:
+            return result
+        # Names further away than these can't make the list.  The full search finds these again (or others that are
+        # just as close), so there is nothing to merge.
+        max_distance = result[-1][1]
+    return [
+        (row.Starsystem.name, row.distance)
+        for row in search_systems(
+            db, name, max_distance=max_distance, max_results=max_results, prefilter=bot.config.ratbot.search_prefilter
+        )
+    ]
+
+
+def benchmark_copy_formats(count=2000000, url=None):
+    """
+    Compares the COPY formats on a synthetic CSV file of starsystems.
+
+    :param count: Number of systems to generate.
+    :param url: Optional database URL.  If present, the encoded data is also COPYed into a temporary table so the time
+        spent by the server can be compared.
+    :return: A list of (format, systems, bytes, encode seconds, copy seconds or None) tuples.
+    """
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    results = []
+    with tempfile.TemporaryFile('w+', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['id', 'edsm_id', 'name', 'x', 'y', 'z'])
+        for ix in range(count):
+            name = "Synthetic {}{}-{} {}{}-{}".format(
+                rng.choice('ABCDEFGH'), rng.choice('ABCDEFGH'), rng.choice('ABCDEFGH'),
+                rng.choice('abcdefgh'), rng.randint(0, 9), rng.randint(0, 9999)
+            )
+            if rng.random() < 0.01:
+                writer.writerow([ix, ix, name, '', '', ''])
+            else:
+                writer.writerow([
+                    ix, ix, name, round(rng.uniform(-40000, 40000), 5), round(rng.uniform(-4000, 4000), 5),
+                    round(rng.uniform(-20000, 70000), 5)
+                ])
+
+        engine = sa.create_engine(url) if url else None
+        for name, encoder in sorted(COPY_FORMATS.items()):
+            csvfile.seek(0)
+            with timed() as t:
+                data = encoder.join(map(encoder.row, _parse_systems(csvfile)))
+            copy_seconds = None
+            if engine is not None:
+                conn = engine.connect()
+                try:
+                    with conn.begin():
+                        temptable = _temp_starsystem_table('_benchmark_starsystem')
+                        temptable.create(conn)
+                        stream = _CopyStream([(data, count)], encoder=encoder)
+                        with timed() as copy_t:
+                            conn.connection.cursor().copy_expert(
+                                "COPY {} ({}) FROM STDIN WITH ({})".format(
+                                    temptable.name, ", ".join(COPY_COLUMNS), encoder.options
+                                ),
+                                stream
+                            )
+                        copy_seconds = copy_t.seconds
+                        temptable.drop(conn)
+                finally:
+                    conn.close()
+            size = len(encoder.header) + len(data) + len(encoder.trailer)
+            results.append((name, count, size, t.seconds, copy_seconds))
+    return results
+
+
+def _percentile(values, fraction):
+    """Returns the value at the given fraction of the way through a sorted list of values."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchmark_search(url, count=5000000, searches=500):
+    """
+    Compares search_systems() with and without its trigram prefilter, and against the query !search used before it
+    (which compares every system), on a synthetic table of starsystems.
+
+    The table is built in a scratch schema that shadows the real one and is thrown away afterwards, so this can be
+    pointed at a live database.  It needs the pg_trgm and fuzzystrmatch extensions.
+
+    :param url: Database URL.
+    :param count: Number of systems to generate.
+    :param searches: Number of searches to time.  Each looks for a random system's name with up to 3 random typos.
+    :return: A dict of {'prefilter': {...}, 'scan': {...}, 'baseline': {...}} latency stats (p50, p99 and max, in
+        seconds), with the number of times the prefilter had to fall back to comparing every system and the number of
+        searches whose results differed.
+    """
+    import random
+
+    rng = random.Random(0)
+    sectors = [
+        "".join(rng.choice('bcdfghjklmnprstvwz') + rng.choice('aeiou') for _ in range(rng.randint(1, 4))).title()
+        for _ in range(5000)
+    ]
+    samples = []
+
+    def batches():
+        rows = []
+        for ix in range(count):
+            if rng.random() < 0.02:
+                name = rng.choice(sectors)
+            else:
+                name = "{} {}{}-{} {}{}-{}".format(
+                    rng.choice(sectors), rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
+                    rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ'), rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ'),
+                    rng.choice('abcdefgh'), rng.randint(0, 9), rng.randint(0, 999)
+                )
+            if len(samples) < searches:
+                samples.append(name)
+            elif rng.random() < searches / count:
+                samples[rng.randrange(searches)] = name
+            name_lower = name.lower()
+            rows.append("{}\t{}\t{}\t{}\t{}\n".format(
+                ix, name_lower, name, name_lower.split(" ")[0], name.count(" ") + 1
+            ))
+            if len(rows) >= COPY_BATCH:
+                yield "".join(rows), len(rows)
+                rows = []
+        if rows:
+            yield "".join(rows), len(rows)
+
+    def typo(name):
+        chars = list(name.lower())
+        for _ in range(rng.randint(0, 3)):
+            pos = rng.randrange(len(chars))
+            op = rng.choice('sid')
+            if op == 's':
+                chars[pos] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+            elif op == 'i':
+                chars.insert(pos, rng.choice('abcdefghijklmnopqrstuvwxyz'))
+            elif len(chars) > 1:
+                del chars[pos]
+        return "".join(chars)
+
+    engine = sa.create_engine(url)
+    conn = engine.connect()
+    transaction = conn.begin()
     try:
-        # Find matching prefixes
-        for prefix in db.query(StarsystemPrefix).filter(
-                StarsystemPrefix.first_word.in_(candidates.keys()),
-                StarsystemPrefix.cume_ratio >= min_ratio,
-                sql.or_(StarsystemPrefix.word_ct > 1, sql.func.length(StarsystemPrefix.first_word) >= min_length)
-        ):
-            # Look through matching words.
-            for ix in candidates[prefix.first_word]:
-                # Bail if there's not enough room for the rest of this prefix.
-                # (e.g. last word of the line was "MCC", with no room for a possible "811")
-                endix = ix + prefix.word_ct
-                if endix > len(words):
-                    break
-                # Try to find the actual system.
-                check = " ".join(words[ix:endix])
-                system = db.query(Starsystem).filter(Starsystem.name_lower == check).first()
-                if not system or (prefix.first_word in results and len(results[prefix.first_word]) > len(system.name)):
-                    continue
-                results[prefix.first_word] = system.name
-        return set(results.values())
+        db = orm.Session(bind=conn)
+        conn.execute(sql.text("CREATE SCHEMA _benchmark_search"))
+        conn.execute(sql.text("SET LOCAL search_path TO _benchmark_search, public"))
+        conn.execute(sql.text("""
+            CREATE TABLE starsystem (
+                eddb_id INTEGER PRIMARY KEY, name_lower TEXT, name TEXT NOT NULL, first_word TEXT NOT NULL,
+                word_ct INTEGER NOT NULL, xz POINT, y NUMERIC, fingerprint BIGINT
+            )
+        """))
+        conn.connection.cursor().copy_expert(
+            "COPY starsystem (eddb_id, name_lower, name, first_word, word_ct) FROM STDIN", _CopyStream(batches())
+        )
+        conn.execute(sql.text("CREATE INDEX ON starsystem USING gin (name_lower gin_trgm_ops)"))
+        conn.execute(sql.text("ANALYZE starsystem"))
+
+        results = {}
+        answers = {}
+        fallbacks = 0
+        names = [typo(name) for name in samples]
+
+        def baseline(name, max_distance=10, max_results=4):
+            expr = sql.func.levenshtein_less_equal(Starsystem.name_lower, name, max_distance)
+            return db.query(Starsystem, expr.label("distance")).filter(expr <= max_distance).order_by(expr.asc())[
+                :max_results
+            ]
+
+        for key in ('prefilter', 'scan', 'baseline'):
+            times = []
+            for name in names:
+                stats = {}
+                with timed() as t:
+                    if key == 'baseline':
+                        result = baseline(name)
+                    else:
+                        result = search_systems(db, name, prefilter=key == 'prefilter', stats=stats)
+                times.append(t.seconds)
+                answers.setdefault(name, []).append([row.distance for row in result])
+                if key == 'prefilter' and stats['limit'] is None:
+                    fallbacks += 1
+            times.sort()
+            results[key] = {'p50': _percentile(times, 0.5), 'p99': _percentile(times, 0.99), 'max': times[-1]}
+        results['fallbacks'] = fallbacks
+        results['mismatches'] = sum(1 for distances in answers.values() if len(set(map(tuple, distances))) > 1)
+        return results
     finally:
-        db.rollback()
+        transaction.rollback()
+        conn.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 2 and sys.argv[1] == 'search':
+        results = benchmark_search(sys.argv[2], *map(int, sys.argv[3:5]))
+        for key in ('prefilter', 'scan', 'baseline'):
+            print("{:9}: p50 {p50:.4f}s, p99 {p99:.4f}s, max {max:.4f}s".format(key, **results[key]))
+        print("{fallbacks} fallback(s) to a full comparison, {mismatches} mismatched result(s)".format(**results))
+        sys.exit()
+    for name, systems, size, encode, copy in benchmark_copy_formats(url=(sys.argv[1] if len(sys.argv) > 1 else None)):
+        print("{:6}: {} systems, {:.1f} MiB, encoded in {:.2f}s, COPY {}".format(
+            name, systems, size / 2**20, encode, "{:.2f}s".format(copy) if copy is not None else "skipped"
+        ))
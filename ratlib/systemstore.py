@@ -0,0 +1,242 @@
+"""
+Memory-mapped, columnar snapshot of the starsystem table.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import array
+import math
+import os
+import shutil
+import struct
+import tempfile
+
+from ratlib.mappedfile import MappedFile
+
+
+__all__ = ['SystemStore']
+
+
+class SystemStore(MappedFile):
+    """
+    Read-only snapshot of every starsystem's id, name and coordinates.  Nothing is decoded until a system is asked for,
+    so loading it costs no more than mapping the file, and lookups, name detection and prefix searches need no
+    database.
+
+    The file consists of a header, followed by an array of offsets into the name blob, an array of eddb_ids, arrays of
+    x, y and z coordinates (as 32-bit floats, with NaN for unknown coordinates), and finally a blob of UTF-8 encoded
+    names (with their original capitalization).  Systems are sorted by their lowercased name, so lookups are a binary
+    search over the offsets array.
+    """
+    # magic, format version, number of systems, size of name blob, timestamp
+    FILE_MAGIC = b'RSTORE'
+    FILE_VERSION = 1
+    FILE_HEADER = struct.Struct('<6sHQQd')
+    FILE_DESCRIPTION = 'system store'
+    OFFSET_TYPE = 'Q'
+    ID_TYPE = 'i'
+    COORD_TYPE = 'f'
+
+    def __init__(self, buffer, count, blob_size):
+        """
+        Wraps an existing buffer.  Normally called by load() rather than directly.
+
+        :param buffer: Buffer (usually a mmap) containing the entire file.
+        :param count: Number of systems.
+        :param blob_size: Size of the name blob, in bytes.
+        """
+        self._buffer = buffer
+        self._count = count
+        view = memoryview(buffer)
+        start = self.FILE_HEADER.size
+
+        def column(typecode, length):
+            nonlocal start
+            end = start + length*array.array(typecode).itemsize
+            result = view[start:end].cast(typecode)
+            start = end
+            return result
+
+        self._offsets = column(self.OFFSET_TYPE, count + 1)
+        self._ids = column(self.ID_TYPE, count)
+        self._x = column(self.COORD_TYPE, count)
+        self._y = column(self.COORD_TYPE, count)
+        self._z = column(self.COORD_TYPE, count)
+        self._blob = view[start:start + blob_size]
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, name_lower):
+        return self.find(name_lower) is not None
+
+    @property
+    def nbytes(self):
+        """Size of the mapped snapshot, in bytes."""
+        return len(self._buffer)
+
+    def name(self, ix):
+        """Returns the name of the system at position ix, with its original capitalization."""
+        return str(self._blob[self._offsets[ix]:self._offsets[ix + 1]], 'utf-8')
+
+    def key(self, ix):
+        """Returns the lowercased name of the system at position ix."""
+        return self.name(ix).lower()
+
+    def eddb_id(self, ix):
+        """Returns the eddb_id of the system at position ix."""
+        return self._ids[ix]
+
+    def coordinates(self, ix):
+        """Returns the coordinates of the system at position ix as a tuple of (x, y, z), or None if unknown."""
+        x = self._x[ix]
+        if math.isnan(x):
+            return None
+        return x, self._y[ix], self._z[ix]
+
+    def bisect_left(self, key, lo=0, hi=None):
+        """
+        Returns the position where key would be inserted to maintain sort order, as with bisect.bisect_left()
+
+        :param key: Lowercased name.
+        :param lo: Lower bound of the search.
+        :param hi: Upper bound of the search.  Defaults to the end of the store.
+        """
+        if hi is None:
+            hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefix_range(self, prefix):
+        """
+        Finds the systems whose names start with a prefix.  Since they sort next to each other, this is two binary
+        searches.
+
+        :param prefix: Lowercased prefix.
+        :return: A tuple of (start, end): positions start through end - 1 are the systems starting with prefix.
+        """
+        lo = start = self.bisect_left(prefix)
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid)[:len(prefix)] == prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def find(self, name_lower):
+        """
+        Finds a system by name.
+
+        :param name_lower: Lowercased name to look up.
+        :return: Position of the system, or None if it isn't in the snapshot.
+        """
+        ix = self.bisect_left(name_lower)
+        if ix < self._count and self.key(ix) == name_lower:
+            return ix
+        return None
+
+    def get(self, name_lower, default=None):
+        """
+        Looks up a system by name.
+
+        :param name_lower: Lowercased name to look up.
+        :param default: Value returned if the system is not in the snapshot.
+        :return: A tuple of (eddb_id, name, coords), where coords is as returned by coordinates(), or default.
+        """
+        ix = self.find(name_lower)
+        if ix is None:
+            return default
+        return self.eddb_id(ix), self.name(ix), self.coordinates(ix)
+
+    def nearest_landmark(self, name_lower, landmarks):
+        """
+        Finds the landmark closest to a system.
+
+        :param name_lower: Lowercased name of the system.
+        :param landmarks: Iterable of landmarks, with x, y and z attributes (such as Landmark rows).  Landmarks with
+            unknown coordinates are ignored.
+        :return: A tuple of (landmark, distance), or (None, None) if the system is unknown or has unknown coordinates,
+            or there are no landmarks.
+        """
+        ix = self.find(name_lower)
+        coords = None if ix is None else self.coordinates(ix)
+        best = best_distance = None
+        if coords is None:
+            return best, best_distance
+        x, y, z = coords
+        for landmark in landmarks:
+            if landmark.x is None or landmark.y is None or landmark.z is None:
+                continue
+            distance = math.sqrt((landmark.x - x)**2 + (landmark.y - y)**2 + (landmark.z - z)**2)
+            if best_distance is None or distance < best_distance:
+                best, best_distance = landmark, distance
+        return best, best_distance
+
+    @classmethod
+    def write(cls, filename, systems, timestamp=0.0):
+        """
+        Writes a new snapshot file, replacing any existing one.
+
+        The name blob comes last but is only complete once every system has been read, so names are spooled to an
+        anonymous temporary file in the meantime.
+
+        :param filename: Path to write to.
+        :param systems: Iterable of (eddb_id, name, coords) tuples, where coords is a tuple of (x, y, z) or None.  They
+            must already be sorted by their lowercased name.
+        :param timestamp: Arbitrary timestamp (as seconds since the epoch) to store with the snapshot.
+        :return: Number of systems written.
+        :raises: ValueError if systems are not sorted.
+        """
+        offsets = array.array(cls.OFFSET_TYPE, [0])
+        ids = array.array(cls.ID_TYPE)
+        columns = tuple(array.array(cls.COORD_TYPE) for axis in 'xyz')
+        unknown = (math.nan,)*3
+        last = None
+        with tempfile.TemporaryFile(dir=os.path.dirname(filename) or None) as blob:
+            for eddb_id, name, coords in systems:
+                key = name.lower()
+                if last is not None and key < last:
+                    raise ValueError("Systems are not sorted: {!r} follows {!r}".format(name, last))
+                last = key
+                encoded = name.encode('utf-8')
+                blob.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                ids.append(eddb_id)
+                for column, value in zip(columns, coords or unknown):
+                    column.append(value)
+            with cls._create(filename, len(ids), offsets[-1], timestamp) as f:
+                offsets.tofile(f)
+                ids.tofile(f)
+                for column in columns:
+                    column.tofile(f)
+                blob.seek(0)
+                shutil.copyfileobj(blob, f)
+        return len(ids)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Memory-maps a snapshot written by write().
+
+        :param filename: Path to read from.
+        :return: A tuple of (store, header), where header is a dict of header fields.
+        :raises: ValueError if the file is invalid.
+        """
+        with open(filename, 'rb') as f:
+            count, blob_size, timestamp = cls._read_header(f)
+            size = cls.FILE_HEADER.size + blob_size + (count + 1)*array.array(cls.OFFSET_TYPE).itemsize + count*(
+                array.array(cls.ID_TYPE).itemsize + 3*array.array(cls.COORD_TYPE).itemsize
+            )
+            buffer = cls._map(f, size)
+        return cls(buffer, count, blob_size), {'count': count, 'timestamp': timestamp}
@@ -11,9 +11,11 @@ See LICENSE.md
 import datetime
 import time
 import contextlib
+import collections
+import threading
 
 
-__all__ = ['TimedResult', 'timed']
+__all__ = ['TimedResult', 'timed', 'LRUCache']
 
 
 class TimedResult:
@@ -46,3 +48,57 @@ def timed():
     result = TimedResult()
     yield result
     result.stop()
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe least-recently-used cache that keeps track of its hit and miss counts.
+    """
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: Maximum number of entries to keep.
+        """
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if there is none.  Counts as a hit or miss accordingly.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entries if needed.
+        """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all entries.  Hit and miss counts are kept.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """
+        Returns a dict of cache statistics: hits, misses, size and maxsize.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
@@ -42,13 +42,13 @@ from sopel.module import require_privmsg, rate
 import ratlib.sopel
 from ratlib import timeutil
 from ratlib.autocorrect import correct
-from ratlib.starsystem import scan_for_systems
+from ratlib.starsystem import scan_for_systems, lookup_system
 from ratlib.api.props import *
 from ratlib.api.names import *
 from ratlib.sopel import UsageError
 import ratlib.api.http
 import ratlib.db
-from ratlib.db import with_session, Starsystem
+from ratlib.db import with_session
 from ratlib.api.v2compatibility import convertV2DataToV1, convertV1RescueToV2
 
 urljoin = ratlib.api.http.urljoin
@@ -1411,7 +1411,7 @@ def cmd_system(bot, trigger, rescue, system, db=None):
     # Try to find the system in EDDB.
     fmt = "Location of {name} set to {rescue.system}"
 
-    result = db.query(Starsystem).filter(Starsystem.name_lower == system.lower()).first()
+    result = lookup_system(bot, db, system)
     if result:
         system = result.name
     else:
@@ -1555,7 +1555,7 @@ def ratmama_parse(bot, trigger, db):
         if result.created:
             # Add IRC formatting to fields, then substitute them into to output to the channel
             # (But only if this is a new case, because we aren't using it otherwise)
-            system = db.query(Starsystem).filter(Starsystem.name_lower == fields["system"].lower()).first()
+            system = lookup_system(bot, db, fields["system"])
 
             if case.codeRed:
                 fields["o2"] = bold(color(fields["o2"], colors.RED))
@@ -33,7 +33,10 @@ from ratlib import timeutil
 import ratlib
 import ratlib.sopel
 from ratlib.db import with_session, Starsystem, StarsystemPrefix, Landmark, get_status
-from ratlib.starsystem import refresh_database, scan_for_systems, ConcurrentOperationError
+from ratlib.starsystem import (
+    refresh_database, scan_for_systems, search_names, complete_system_name, lookup_system,
+    get_scan_cache, get_system_cache, list_snapshots, ConcurrentOperationError
+)
 from ratlib.autocorrect import correct
 import re
 from ratlib.api.names import require_permission, Permissions
@@ -85,27 +88,50 @@ def search(bot, trigger, db=None):
 
     system = system.lower()
 
-    # Levenshtein expression
+    # Levenshtein distance limits
     max_distance = 10
     max_results = 4
-    expr = sql.func.levenshtein_less_equal(Starsystem.name_lower, system, max_distance)
 
     # Query
-    result = (
-        db.query(Starsystem, expr.label("distance"))
-        .filter(expr <= max_distance)
-        .order_by(expr.asc())
-    )[:max_results]
-
+    result = search_names(bot, system, max_distance=max_distance, max_results=max_results, db=db)
 
     if result:
         return bot.say("Nearest matches for {system_name} are: {matches}".format(
             system_name=system_name,
-            matches=", ".join('"{0.Starsystem.name}" [{0.distance}]'.format(row) for row in result)
+            matches=", ".join('"{}" [{}]'.format(name, distance) for name, distance in result)
         ))
     return bot.say("No similar results for {system_name}".format(system_name=system_name))
 
 
+@commands('complete')
+@example('!complete eol prou', '')
+@with_session
+def cmd_complete(bot, trigger, db=None):
+    """
+    Lists systems with names starting with what was typed.
+    """
+    prefix = trigger.group(2)
+    if prefix:
+        prefix = re.sub(r'\s\s+', ' ', prefix.strip())
+    if not prefix:
+        bot.reply("Usage: {} <start of system name>".format(trigger.group(1)))
+        return
+
+    limit = 10
+    names, total = complete_system_name(bot, prefix.lower(), limit=limit, db=db)
+    if not names:
+        return bot.say("No systems start with \"{}\"".format(prefix))
+    if total is None:
+        more = " and more"
+    elif total > len(names):
+        more = " and {} more".format(total - len(names))
+    else:
+        more = ""
+    return bot.say("Systems starting with \"{}\": {}{}".format(
+        prefix, ", ".join('"{}"'.format(name) for name in names), more
+    ))
+
+
 def refresh_time_stats(bot):
     """
     Returns formatted stats on the last refresh.
@@ -113,10 +139,28 @@ def refresh_time_stats(bot):
     stats = bot.memory['ratbot']['stats'].get('starsystem_refresh')
     if not stats:
         return "No starsystem refresh stats are available."
+    if stats.get('unchanged'):
+        return "Starsystem data was unchanged upstream; refresh skipped after {total:.2f} seconds.".format(**stats)
+    chunks = stats.get('chunks')
     return (
         "Refresh took {total:.2f} seconds.  (Load: {load:.2f}, Prune: {prune:.2f}, Systems: {systems:.2f},"
-        " Prefixes: {prefixes:.2f}, Stats: {stats:.2f}, Optimize: {optimize:.2f}, Bloom: {bloom:.2f}, Misc: {misc:.2f})"
+        " Prefixes: {prefixes:.2f}, Stats: {stats:.2f} ({prefix_stats}), Optimize: {optimize:.2f}, Bloom: {bloom:.2f},"
+        " Store: {store:.2f}, Misc: {misc:.2f})"
+        "  Loaded {ingest[systems]} systems at {ingest[rate]:.0f}/second."
         .format(**stats)
+    ) + (
+        "  Shadow tables took {shadow:.2f} seconds to build and {swap:.3f} seconds to swap in.".format(**stats)
+        if stats.get('swap') is not None else ""
+    ) + (
+        "  {added} new, {updated} updated, {unchanged} unchanged.".format(**stats['changes'])
+        if stats.get('changes') else ""
+    ) + (
+        "  {count} chunks ({unchanged} unchanged), slowest download took {slowest:.2f} seconds."
+        .format(
+            count=len(chunks), unchanged=sum(1 for chunk in chunks if chunk.get('unchanged')),
+            slowest=max(chunk['download'] for chunk in chunks)
+        )
+        if chunks else ""
     )
 
 
@@ -130,7 +174,7 @@ def cmd_sysstats(bot, trigger, db=None):
             result = result.filter(*filters)
         return result.scalar()
 
-    all_options = {'count', 'bloom', 'refresh', 'all'}
+    all_options = {'count', 'bloom', 'refresh', 'index', 'cache', 'all'}
     options = (set((trigger.group(2) or '').lower().split(' ')) & all_options) or {'count'}
     if 'all' in options:
         options = all_options
@@ -175,6 +219,36 @@ def cmd_sysstats(bot, trigger, db=None):
                 .format(k=bloom.k, m=bloom.m, pct=bloom.false_positive_chance(), numset=bloom.setbits, **stats)
             )
 
+    if 'cache' in options:
+        scan = get_scan_cache(bot).info()
+        autocorrect = correct.cache_info()
+        bot.say(
+            "Scan cache: {scan[hits]} hits, {scan[misses]} misses, {scan[size]}/{scan[maxsize]} entries."
+            "  Autocorrect cache: {autocorrect.hits} hits, {autocorrect.misses} misses,"
+            " {autocorrect.currsize}/{autocorrect.maxsize} entries."
+            .format(scan=scan, autocorrect=autocorrect)
+        )
+        lookup = get_system_cache(bot).info()
+        total = lookup['hits'] + lookup['negative_hits'] + lookup['misses']
+        bot.say(
+            "System lookup cache: {lookup[hits]} hits, {lookup[negative_hits]} negative hits, {lookup[misses]} misses"
+            " ({rate:.1%} hit rate), {lookup[size]}/{lookup[maxsize]} systems and"
+            " {lookup[negative_size]}/{lookup[negative_maxsize]} missing names."
+            .format(lookup=lookup, rate=(lookup['hits'] + lookup['negative_hits']) / total if total else 0)
+        )
+
+    if 'index' in options:
+        stats = bot.memory['ratbot']['stats'].get('starsystem_store')
+        store = bot.memory['ratbot'].get('starsystem_store')
+
+        if not stats or not store:
+            bot.say("System store is unavailable.")
+        else:
+            bot.say(
+                "System store has {entries} systems, {size:.1f} MiB mapped.  Built or loaded in {time:.2f} seconds."
+                .format(size=store.nbytes / 2**20, **stats)
+            )
+
 
 def task_sysrefresh(bot):
     try:
@@ -190,6 +264,9 @@ def cmd_sysrefresh(bot, trigger, db=None):
     Refreshes the starsystem database if you have halfop or better.  Reports the last refresh time otherwise.
 
     -f: Force refresh even if data is stale.  Requires op.
+    -u: Reload data even if it is unchanged upstream.  Requires op.
+    -l: Reload data from the local snapshot instead of downloading it.  Implies -f.  Requires op.
+    -r: Recompute all prefix statistics from the database, rather than from the data that was loaded.  Requires op.
     """
     access = ratlib.sopel.best_channel_mode(bot, trigger.nick)
     privileged = access & (HALFOP | OP)
@@ -199,13 +276,22 @@ def cmd_sysrefresh(bot, trigger, db=None):
         options = "" if not trigger.group(2) or trigger.group(2)[0] != '-' else trigger.group(2)[1:]
         force = 'f' in options and (access & OP)
         prune = not ('p' in options and (access & OP))
+        conditional = not ('u' in options and (access & OP))
+        local = 'l' in options and (access & OP)
+        rebuild = 'r' in options and (access & OP)
+        if local and not list_snapshots(bot):
+            bot.say("There is no local snapshot of starsystem data to reload.")
+            return
 
 
         try:
             refreshed = refresh_database(
                 bot,
-                force=force,
+                force=force or local,
                 prune=prune,
+                conditional=conditional,
+                local=local,
+                rebuild=rebuild,
                 callback=lambda: bot.say("Starting starsystem refresh...")
             )
             if refreshed:
@@ -236,8 +322,16 @@ def cmd_scan(bot, trigger):
         bot.reply("Usage: {} <line of text>".format(trigger.group(1)))
 
     line = trigger.group(2).strip()
-    results = scan_for_systems(bot, line)
-    bot.say("Scan results: {}".format(", ".join(results) if results else "no match found"))
+    stats = {}
+    results = scan_for_systems(bot, line, stats=stats)
+    bot.say(
+        "Scan results: {} ({})".format(
+            ", ".join(results) if results else "no match found",
+            "cached" if stats['cached'] else "{candidates} candidate(s), {queries} quer{plural}".format(
+                plural='y' if stats['queries'] == 1 else 'ies', **stats
+            )
+        )
+    )
 
 
 @commands('plot')
@@ -277,10 +371,7 @@ def cmd_plot(bot, trigger, db=None):
             bot.reply('Usage: !plot <starting system> to <destination system>')
             return NOLIMIT
 
-        systems = list(
-            db.query(Starsystem).filter(Starsystem.name_lower == name.lower()).first()
-            for name in names
-        )
+        systems = list(lookup_system(bot, db, name) for name in names)
         for name, system in zip(names, systems):
             if system is None:
                 bot.reply('Unable to plot; system "{}" is not in the database.'.format(name))
@@ -396,14 +487,14 @@ def cmd_landmark(bot, trigger, db=None):
     subcommand = parts.pop(0).lower() if parts else None
     system_name = parts.pop(0) if parts else None
 
-    def lookup_system(name, model=Starsystem):
-        return db.query(model).filter(model.name_lower == name.lower()).first()
+    def lookup_landmark(name):
+        return db.query(Landmark).filter(Landmark.name_lower == name.lower()).first()
 
     def get_system_or_none(name):
         if not system_name:
             bot.reply("A starsystem name must be specified")
             return None
-        starsystem = lookup_system(system_name)
+        starsystem = lookup_system(bot, db, system_name)
         if not starsystem:
             bot.reply("Starsystem '{}' is not in the database".format(system_name))
             return None
@@ -461,7 +552,7 @@ def cmd_landmark(bot, trigger, db=None):
     # @require_overseer(None)
     @require_permission(Permissions.overseer, message=None)
     def subcommand_del(*unused_args, **unused_kwargs):
-        landmark = lookup_system(system_name, Landmark)
+        landmark = lookup_landmark(system_name)
         if landmark is None:
             bot.reply("No such landmark '{}'".format(system_name))
             return
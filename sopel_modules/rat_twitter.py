@@ -24,7 +24,8 @@ from twitter import TwitterError
 
 import ratlib.sopel
 from ratlib.api.names import Permissions, require_permission
-from ratlib.db import with_session, Starsystem
+from ratlib.db import with_session
+from ratlib.starsystem import lookup_system
 from ratlib.sopel import parameterize
 
 
@@ -158,13 +159,7 @@ def cmd_tweet(bot, trigger, line):
     pass
 
 
-def get_tweet_for_case(rescue, db):
-
-    def lookup_system(name, model=Starsystem):
-        if name is not None:
-            return db.query(model).filter(model.name_lower == name.lower()).first()
-        return None
-
+def get_tweet_for_case(bot, rescue, db):
     platform = rescue.platform.upper()
     cr = "CR " if rescue.codeRed else ""
 
@@ -174,7 +169,7 @@ def get_tweet_for_case(rescue, db):
     if db is None:
         return message
 
-    starsystem = lookup_system(rescue.system)
+    starsystem = lookup_system(bot, db, rescue.system)
     if starsystem:
         landmark, distance = starsystem.nearest_landmark(db, True)
 
@@ -225,7 +220,7 @@ def cmd_tweetc(bot, trigger, rescue, db = None):
         bot.say('The case has no assigned system. Please do this before sending a tweet.')
         return
 
-    message = get_tweet_for_case(rescue, db)
+    message = get_tweet_for_case(bot, rescue, db)
 
     if not message:
         bot.say('An unknown error occurred. Speak with your local Tech Rats')
@@ -0,0 +1,151 @@
+"""
+Shared fixtures for the ratlib tests.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import http.server
+import os
+import threading
+import types
+
+import pytest
+
+DATABASE = os.environ.get('RATBOT_TEST_DATABASE')  # PostgreSQL database that tests may freely modify, if any.
+
+
+class StandIn:
+    """
+    Local HTTP server standing in for the sites that starsystem data is downloaded from.
+
+    Files are served from `files`, which maps a path to a dict with a 'body' and optionally an 'etag' and
+    'last_modified'.  Conditional requests are answered with 304 Not Modified when their validators match, unless
+    `conditional` is False.  Every request's path and headers are appended to `requests`.
+    """
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.conditional = True
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/".format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stand-in', daemon=True)
+
+    def add(self, path, body, etag=None, last_modified=None):
+        """Serves body (str or bytes) at path, returning its full URL."""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.files[path] = {'body': body, 'etag': etag, 'last_modified': last_modified}
+        return self.url + path
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.lstrip('/')
+                stand_in.requests.append((path, dict(self.headers)))
+                file = stand_in.files.get(path)
+                if file is None:
+                    self.send_error(404)
+                    return
+                if stand_in.conditional and (
+                    (file['etag'] and self.headers.get('If-None-Match') == file['etag']) or
+                    (file['last_modified'] and self.headers.get('If-Modified-Since') == file['last_modified'])
+                ):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(file['body'])))
+                if file['etag']:
+                    self.send_header('ETag', file['etag'])
+                if file['last_modified']:
+                    self.send_header('Last-Modified', file['last_modified'])
+                self.end_headers()
+                self.wfile.write(file['body'])
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    with StandIn() as server:
+        yield server
+
+
+@pytest.fixture
+def bot(tmp_path):
+    """Just enough of a bot for the parts of ratlib that only need its configuration and memory."""
+    ratbot = types.SimpleNamespace(workdir=str(tmp_path))
+    return types.SimpleNamespace(
+        config=types.SimpleNamespace(ratbot=ratbot),
+        memory={'ratbot': {'stats': {}}}
+    )
+
+
+
+@pytest.fixture
+def refresh_bot(bot, stand_in):
+    """
+    A bot with a database and a single, unchunked source of starsystem data on the stand-in server.
+
+    Needs a UTF8-encoded PostgreSQL database with the fuzzystrmatch extension, whose URL is given by the
+    RATBOT_TEST_DATABASE environment variable.  The database is migrated to the current schema, and its starsystem
+    tables are emptied.  Without it, tests using this are skipped.
+    """
+    if not DATABASE:
+        pytest.skip("RATBOT_TEST_DATABASE is not set")
+    import ratlib.db
+    bot.config.ratbot.__dict__.update(
+        database=DATABASE, alembic=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'alembic.ini'),
+        edsm_url=stand_in.url + 'systems.csv', edsm_maxage=None, chunked_systems=False, edsm_chunk_workers=None,
+        edsm_resumable=False, edsm_copy_format=None, edsm_shadow_tables=False, bloom_max_fp=None, system_store=False,
+        search_prefilter=False
+    )
+    ratlib.db.setup(bot)
+    db = ratlib.db.get_session(bot)
+    db.execute("TRUNCATE starsystem, starsystem_prefix CASCADE")
+    status = ratlib.db.get_status(db)
+    status.starsystem_refreshed = status.starsystem_checked = status.starsystem_validators = None
+    db.commit()
+    db.close()
+    yield bot
+    bot.memory['ratbot']['db'].get_bind().dispose()
+
+
+@pytest.fixture
+def refresh(refresh_bot):
+    """
+    Returns a function that refreshes starsystems (as with _refresh_database(); keyword arguments are passed on),
+    returning the refresh statistics, the resulting Status and a sorted list of system names.
+    """
+    from ratlib.db import get_session, get_status, Starsystem
+    from ratlib.starsystem import _refresh_database
+
+    def refresh(**kwargs):
+        assert _refresh_database(refresh_bot, force=True, **kwargs)
+        db = get_session(refresh_bot)
+        try:
+            status = get_status(db)
+            db.expunge(status)
+            names = sorted(row[0] for row in db.query(Starsystem.name))
+        finally:
+            db.close()
+        return refresh_bot.memory['ratbot']['stats']['starsystem_refresh'], status, names
+    return refresh
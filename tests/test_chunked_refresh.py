@@ -0,0 +1,140 @@
+"""
+Tests for downloading starsystem data in chunks.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import functools
+import json
+import threading
+
+from ratlib.starsystem import (
+    TextCopyFormat, _Deduplicator, _PrefixCounter, _SourceTracker, _chunk_batches, _fetch_chunk, _snapshot_base,
+    list_snapshots
+)
+
+
+def systems_csv(systems):
+    """Formats (eddb_id, name) pairs as starsystem CSV data."""
+    return "id,name,x,y,z\n" + "".join(
+        "{0},{1},{0}.5,{0}.25,-{0}\n".format(eddb_id, name) for eddb_id, name in systems
+    )
+
+
+def load_chunks(bot, urls, workers=3):
+    """
+    Runs urls through _chunk_batches() the way a chunked refresh does.
+
+    :return: A tuple of ({eddb_id: name} as it would be after duplicates are replaced, number of rows COPYed, per-chunk
+        stats, log messages, the _PrefixCounter)
+    """
+    tracker = _SourceTracker()
+    dedupe = _Deduplicator()
+    counter = _PrefixCounter()
+    messages = []
+    stats = []
+    chunks = [(url, functools.partial(_fetch_chunk, url, _snapshot_base(bot, url), tracker)) for url in urls]
+    log = lambda fmt, *args: messages.append(fmt.format(*args))
+    batches = _chunk_batches(chunks, log, stats, counter, workers, TextCopyFormat, dedupe)
+    rows = "".join(text for text, count in batches).splitlines()
+    loaded = dict((int(row.split("\t")[0]), row.split("\t")[2]) for row in rows)
+    loaded.update((eddb_id, system[2]) for eddb_id, system in dedupe.duplicates.items())
+    return loaded, len(rows), stats, messages, counter
+
+
+def test_every_row_arrives(bot, stand_in):
+    sectors = dict(
+        ("sector{}.csv".format(sector), [(sector * 100 + ix, "Sector {} {}".format(sector, ix)) for ix in range(50)])
+        for sector in range(8)
+    )
+    urls = [stand_in.add(path, systems_csv(systems)) for path, systems in sectors.items()]
+
+    loaded, copied, stats, messages, counter = load_chunks(bot, urls)
+
+    expected = dict(system for systems in sectors.values() for system in systems)
+    assert loaded == expected
+    assert copied == len(expected)
+    assert [chunk['url'] for chunk in stats] == urls
+    assert all(chunk['systems'] == 50 and not chunk['unchanged'] for chunk in stats)
+    assert counter.complete
+    assert sum(counter.counts.values()) == len(expected)
+
+
+def test_duplicates_are_resolved(bot, stand_in):
+    urls = [
+        stand_in.add("a.csv", systems_csv([(1, "Alpha"), (2, "Beta"), (3, "Gamma")])),
+        stand_in.add("b.csv", systems_csv([(3, "Gamma Prime"), (4, "Delta")])),
+        stand_in.add("c.csv", systems_csv([(5, "Epsilon"), (1, "Alpha Prime")])),
+    ]
+
+    loaded, copied, stats, messages, counter = load_chunks(bot, urls)
+
+    # Each system is COPYed once, and the last copy of it in chunk order replaces it.
+    assert copied == 5
+    assert loaded == {1: "Alpha Prime", 2: "Beta", 3: "Gamma Prime", 4: "Delta", 5: "Epsilon"}
+
+
+def test_duplicates_are_resolved_in_chunk_order(bot, stand_in, monkeypatch):
+    urls = [
+        stand_in.add("first.csv", systems_csv([(1, "Early")])),
+        stand_in.add("second.csv", systems_csv([(1, "Late")])),
+    ]
+    # Hold up the first chunk until the second one has been downloaded.
+    second_done = threading.Event()
+    get = _SourceTracker.get
+
+    def slow_get(self, url, conditional=True):
+        if url == urls[0]:
+            assert second_done.wait(10)
+        response = get(self, url, conditional)
+        if url == urls[1]:
+            second_done.set()
+        return response
+
+    monkeypatch.setattr(_SourceTracker, 'get', slow_get)
+    loaded, copied, stats, messages, counter = load_chunks(bot, urls, workers=2)
+
+    assert loaded == {1: "Late"}
+    assert [chunk['url'] for chunk in stats] == urls
+
+
+def test_failed_chunk_is_reported(bot, stand_in):
+    urls = [
+        stand_in.add("good.csv", systems_csv([(1, "Alpha"), (2, "Beta")])),
+        stand_in.url + "missing.csv",
+    ]
+
+    loaded, copied, stats, messages, counter = load_chunks(bot, urls)
+
+    assert loaded == {1: "Alpha", 2: "Beta"}
+    assert [chunk['url'] for chunk in stats] == [urls[0]]
+    assert "Failed to retrieve data at {}".format(urls[1]) in messages
+    # Prefix statistics can't be streamed when systems are missing.
+    assert not counter.complete
+
+
+def test_local_reload_keeps_chunk_order(refresh_bot, refresh, stand_in):
+    # List the chunks in the opposite order to the names of their snapshots.
+    urls = sorted(
+        (stand_in.url + path for path in ("first.csv", "second.csv")),
+        key=lambda url: _snapshot_base(refresh_bot, url), reverse=True
+    )
+    stand_in.add(urls[0][len(stand_in.url):], systems_csv([(1, "Early"), (2, "Alpha")]))
+    stand_in.add(urls[1][len(stand_in.url):], systems_csv([(1, "Late"), (3, "Beta")]))
+    refresh_bot.config.ratbot.chunked_systems = True
+    refresh_bot.config.ratbot.edsm_url = stand_in.add(
+        "index.json", json.dumps([{"SectorName": url[len(stand_in.url):]} for url in urls])
+    )
+
+    stats, status, names = refresh()
+    assert names == ["Alpha", "Beta", "Late"]
+    assert [path.rsplit('.', 2)[0] for path in list_snapshots(refresh_bot)] == [
+        _snapshot_base(refresh_bot, url) for url in urls
+    ]
+
+    stats, status, names = refresh(local=True)
+    assert names == ["Alpha", "Beta", "Late"]
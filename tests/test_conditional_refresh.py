@@ -0,0 +1,142 @@
+"""
+Tests for skipping starsystem refreshes when upstream data is unchanged.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import gzip
+import json
+
+import pytest
+
+from ratlib.db import get_session
+from ratlib.starsystem import STAGING_TABLE, CHECKPOINT_TABLE
+
+LAST_MODIFIED = 'Mon, 02 Jan 2017 03:04:05 GMT'
+
+
+def systems_csv(*names):
+    """Formats names as starsystem CSV data, numbering them from 1."""
+    return "id,name,x,y,z\n" + "".join(
+        "{0},{1},{0}.5,{0}.25,-{0}\n".format(eddb_id, name) for eddb_id, name in enumerate(names, 1)
+    )
+
+
+@pytest.mark.parametrize('validators', [
+    {'etag': '"v1"'}, {'last_modified': LAST_MODIFIED}, {'etag': '"v1"', 'last_modified': LAST_MODIFIED}
+])
+def test_not_modified(refresh_bot, refresh, stand_in, validators):
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), **validators)
+    stats, first, names = refresh()
+    assert not stats['unchanged']
+    assert names == ["Alpha", "Beta"]
+    assert first.starsystem_refreshed is not None and first.starsystem_checked is None
+
+    stats, second, names = refresh()
+    path, headers = stand_in.requests[-1]
+    if 'etag' in validators:
+        assert headers['If-None-Match'] == validators['etag']
+    if 'last_modified' in validators:
+        assert headers['If-Modified-Since'] == validators['last_modified']
+    assert stats['unchanged']
+    assert names == ["Alpha", "Beta"]
+    assert second.starsystem_refreshed == first.starsystem_refreshed
+    assert second.starsystem_checked > first.starsystem_refreshed
+    assert second.starsystem_validators == first.starsystem_validators
+
+
+def test_unchanged_body(refresh_bot, refresh, stand_in):
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v1"')
+    stats, first, names = refresh()
+
+    # A server that ignores the validators sends everything again, but it hashes the same.
+    stand_in.conditional = False
+    stats, second, names = refresh()
+    assert stand_in.requests[-1][1]['If-None-Match'] == '"v1"'
+    assert stats['unchanged']
+    assert second.starsystem_refreshed == first.starsystem_refreshed
+    assert second.starsystem_checked > first.starsystem_refreshed
+
+    stats, third, names = refresh()
+    assert stats['unchanged']
+    assert third.starsystem_refreshed == first.starsystem_refreshed
+    assert third.starsystem_checked > second.starsystem_checked
+
+
+def test_changed_body(refresh_bot, refresh, stand_in):
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v1"', last_modified=LAST_MODIFIED)
+    stats, first, names = refresh()
+
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta", "Gamma"), etag='"v2"')
+    stats, second, names = refresh()
+    assert not stats['unchanged']
+    assert stats['changes'] == {'added': 1, 'updated': 0, 'unchanged': 2}
+    assert names == ["Alpha", "Beta", "Gamma"]
+    assert second.starsystem_refreshed > first.starsystem_refreshed
+    assert second.starsystem_checked is None
+    validators = second.starsystem_validators[refresh_bot.config.ratbot.edsm_url]
+    assert validators['etag'] == '"v2"' and validators['last_modified'] is None
+    assert validators['sha256'] != first.starsystem_validators[refresh_bot.config.ratbot.edsm_url]['sha256']
+
+    # The new validators are the ones sent next time.
+    stats, third, names = refresh()
+    assert stand_in.requests[-1][1]['If-None-Match'] == '"v2"'
+    assert stats['unchanged']
+    assert third.starsystem_refreshed == second.starsystem_refreshed
+
+
+def test_resumable_refresh_leaves_no_tables(refresh_bot, refresh, stand_in):
+    refresh_bot.config.ratbot.edsm_resumable = True
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v1"')
+    stats, first, names = refresh()
+    assert names == ["Alpha", "Beta"]
+
+    for conditional in (True, False):
+        # Once with a 304, once with the same body again.
+        stand_in.conditional = conditional
+        stats, status, names = refresh()
+        assert stats['unchanged']
+        assert status.starsystem_refreshed == first.starsystem_refreshed
+        db = get_session(refresh_bot)
+        try:
+            tables = db.execute(
+                "SELECT to_regclass('{}'), to_regclass('{}')".format(STAGING_TABLE, CHECKPOINT_TABLE)
+            ).first()
+        finally:
+            db.close()
+        assert tables == (None, None)
+
+
+@pytest.mark.parametrize('mode', ['single', 'resumable', 'chunked'])
+def test_unreadable_body_is_retrieved_again(refresh_bot, refresh, stand_in, mode):
+    names = ["System {}".format(ix) for ix in range(1, 501)]
+    body = gzip.compress(systems_csv(*names).encode('utf-8'))
+    url = stand_in.add('systems.csv.gz', body[:len(body) // 2], etag='"v1"')
+    if mode == 'chunked':
+        refresh_bot.config.ratbot.chunked_systems = True
+        refresh_bot.config.ratbot.edsm_url = stand_in.add('index.json', json.dumps([{"SectorName": "systems.csv.gz"}]))
+    else:
+        refresh_bot.config.ratbot.edsm_url = url
+        refresh_bot.config.ratbot.edsm_resumable = mode == 'resumable'
+
+    if mode == 'resumable':
+        # Resuming would only fail at the same place again, so the refresh stops.
+        with pytest.raises(EOFError):
+            refresh()
+    else:
+        stats, status, loaded = refresh()
+        assert url not in (status.starsystem_validators or {})
+
+    # Whatever went wrong the first time, the same validators now come with the whole body.
+    stand_in.add('systems.csv.gz', body, etag='"v1"')
+    stats, status, loaded = refresh()
+    assert 'If-None-Match' not in stand_in.requests[-1][1]
+    assert not stats['unchanged']
+    assert loaded == sorted(names)
+    assert status.starsystem_validators[url]['etag'] == '"v1"'
@@ -0,0 +1,63 @@
+"""
+Tests for loading starsystems with each COPY format.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import pytest
+
+from ratlib.db import get_session
+
+SYSTEMS_CSV = (
+    "id,name,x,y,z\n"
+    "1,Sol,0,0,0\n"
+    "2,Col 285 Sector AB-C d1-23,-123.40625,-0.03125,-9876.5\n"
+    "3,Pâle Étoile,1.5,-2.25,3.125\n"
+    "4,Σ Ορίων,-0.0001,42,-42\n"
+    "5,Lost  Somewhere,,,\n"
+    "6,Half Known,1.5,,3\n"
+    "2147483647,Largest Id,65535.96875,-65535.96875,1e-05\n"
+)
+
+
+def load(refresh, refresh_bot, stand_in, copy_format):
+    """Refreshes SYSTEMS_CSV using copy_format, returning every starsystem row ordered by eddb_id."""
+    # Each format gets a URL of its own, so that the second load isn't skipped as unchanged.
+    refresh_bot.config.ratbot.edsm_copy_format = copy_format
+    refresh_bot.config.ratbot.edsm_url = stand_in.add('{}.csv'.format(copy_format), SYSTEMS_CSV)
+    refresh()
+    db = get_session(refresh_bot)
+    try:
+        return db.execute(
+            "SELECT eddb_id, name_lower, name, first_word, word_ct, xz[0], xz[1], y, fingerprint"
+            " FROM starsystem ORDER BY eddb_id"
+        ).fetchall()
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize('resumable', [False, True])
+def test_binary_matches_text(refresh_bot, refresh, stand_in, resumable):
+    refresh_bot.config.ratbot.edsm_resumable = resumable
+    text = load(refresh, refresh_bot, stand_in, 'text')
+    db = get_session(refresh_bot)
+    db.execute("TRUNCATE starsystem, starsystem_prefix CASCADE")
+    db.commit()
+    db.close()
+    binary = load(refresh, refresh_bot, stand_in, 'binary')
+
+    assert binary == text
+    assert [row.eddb_id for row in binary] == [1, 2, 3, 4, 5, 6, 2147483647]
+    rows = dict((row.eddb_id, row) for row in binary)
+    assert rows[2][5:8] == (-123.40625, -9876.5, -0.03125)
+    assert rows[3].name == "Pâle Étoile" and rows[3].name_lower == "pâle étoile"
+    assert rows[4].first_word == "σ" and rows[4].word_ct == 2
+    assert rows[5].name == "Lost Somewhere" and rows[5][5:8] == (None, None, None)
+    assert rows[6][5:8] == (None, None, None)
+    assert rows[2147483647][5:8] == (65535.96875, 1e-05, -65535.96875)
@@ -0,0 +1,65 @@
+"""
+Tests for computing starsystem prefix statistics during refreshes.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import collections
+
+import pytest
+
+from ratlib.db import get_session
+
+
+def systems_csv(systems):
+    """Formats (eddb_id, name) pairs as starsystem CSV data."""
+    return "id,name,x,y,z\n" + "".join(
+        "{0},{1},{0}.5,{0}.25,-{0}\n".format(eddb_id, name) for eddb_id, name in systems
+    )
+
+
+def expected_stats(names):
+    """Returns {(first_word, word_ct): (ratio, cume_ratio)} as it should be for a starsystem table holding names."""
+    counts = collections.Counter((name.lower().split()[0], len(name.split())) for name in names)
+    totals = collections.Counter()
+    for (first_word, word_ct), count in counts.items():
+        totals[first_word] += count
+    result = {}
+    for first_word, word_ct in counts:
+        cume = sum(count for (word, ct), count in counts.items() if word == first_word and ct <= word_ct)
+        result[first_word, word_ct] = (counts[first_word, word_ct] / totals[first_word], cume / totals[first_word])
+    return result
+
+
+def prefix_stats(bot):
+    """Returns {(first_word, word_ct): (ratio, cume_ratio)} as stored."""
+    db = get_session(bot)
+    try:
+        return dict(
+            ((first_word, word_ct), (ratio, cume_ratio))
+            for first_word, word_ct, ratio, cume_ratio in db.execute(
+                "SELECT first_word, word_ct, ratio, cume_ratio FROM starsystem_prefix"
+            )
+        )
+    finally:
+        db.close()
+
+
+@pytest.mark.parametrize('shadow', [False, True])
+def test_unpublished_systems_still_count(refresh_bot, refresh, stand_in, shadow):
+    refresh_bot.config.ratbot.edsm_shadow_tables = shadow
+    stand_in.add('systems.csv', systems_csv([(1, "Alpha"), (2, "Beta A"), (3, "Beta B C"), (4, "Gamma")]), etag='"v1"')
+    refresh()
+
+    # Alpha and Beta B C are no longer published, but they are still in the table.
+    stand_in.add('systems.csv', systems_csv([(2, "Beta A"), (4, "Gamma"), (5, "Gamma D")]), etag='"v2"')
+    stats, status, names = refresh()
+    assert names == ["Alpha", "Beta A", "Beta B C", "Gamma", "Gamma D"]
+    assert stats['prefix_stats'] == 'streamed'
+    assert prefix_stats(refresh_bot) == pytest.approx(expected_stats(names))
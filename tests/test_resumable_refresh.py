@@ -0,0 +1,101 @@
+"""
+Tests for resuming interrupted starsystem refreshes.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import collections
+
+import pytest
+
+import ratlib.starsystem
+from ratlib.db import get_session
+from ratlib.starsystem import CHECKPOINT_TABLE
+
+NAMES = ["Col 285 Sector AB-C d1", "Col 285 Sector DE-F d2", "Col 285", "Col 1", "Sol", "Wregoe ZE-M b1", "Wregoe"]
+
+
+def systems_csv(names):
+    """Formats names as starsystem CSV data, numbering them from 1."""
+    return "id,name,x,y,z\n" + "".join(
+        "{0},{1},{0}.5,{0}.25,-{0}\n".format(eddb_id, name) for eddb_id, name in enumerate(names, 1)
+    )
+
+
+def expected_stats(names):
+    """Returns {(first_word, word_ct): (ratio, cume_ratio)} as it should be for a starsystem table holding names."""
+    counts = collections.Counter((name.lower().split()[0], len(name.split())) for name in names)
+    totals = collections.Counter()
+    for (first_word, word_ct), count in counts.items():
+        totals[first_word] += count
+    result = {}
+    for first_word, word_ct in sorted(counts):
+        cume = sum(count for (word, ct), count in counts.items() if word == first_word and ct <= word_ct)
+        result[first_word, word_ct] = (counts[first_word, word_ct] / totals[first_word], cume / totals[first_word])
+    return result
+
+
+def prefix_stats(bot):
+    """Returns {(first_word, word_ct): (ratio, cume_ratio)} as stored."""
+    db = get_session(bot)
+    try:
+        return dict(
+            ((first_word, word_ct), (ratio, cume_ratio))
+            for first_word, word_ct, ratio, cume_ratio in db.execute(
+                "SELECT first_word, word_ct, ratio, cume_ratio FROM starsystem_prefix"
+            )
+        )
+    finally:
+        db.close()
+
+
+def interrupt(monkeypatch, after=None):
+    """
+    Makes the next resumable load stop partway through, as if the bot had been shut down.
+
+    :param after: Stop once a checkpoint holds at least this many systems, or once loading has finished if None.
+    """
+    load = ratlib.starsystem._load_resumable
+
+    def checkpointed(count):
+        if count >= after:
+            raise KeyboardInterrupt
+
+    def interrupted(bot, engine, url, tracker, encoder, log, progress=None, *args, **kwargs):
+        monkeypatch.setattr(ratlib.starsystem, '_load_resumable', load)
+        load(bot, engine, url, tracker, encoder, log, progress if after is None else checkpointed, *args, **kwargs)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(ratlib.starsystem, '_load_resumable', interrupted)
+
+
+@pytest.mark.parametrize('after', [3, None], ids=['partial', 'complete'])
+def test_interrupted_load_resumes(refresh_bot, refresh, stand_in, monkeypatch, after):
+    refresh_bot.config.ratbot.edsm_resumable = True
+    monkeypatch.setattr(ratlib.starsystem, 'CHECKPOINT_THRESHOLD', 3)
+    stand_in.add('systems.csv', systems_csv(NAMES), etag='"v1"')
+    interrupt(monkeypatch, after)
+    with pytest.raises(KeyboardInterrupt):
+        refresh()
+    db = get_session(refresh_bot)
+    try:
+        assert db.execute("SELECT flushed, complete FROM {}".format(CHECKPOINT_TABLE)).first() == (
+            (len(NAMES), True) if after is None else (after, False)
+        )
+    finally:
+        db.close()
+
+    stats, status, names = refresh()
+    # The data was only downloaded once, and every system was loaded once.
+    assert [path for path, headers in stand_in.requests] == ['systems.csv']
+    assert names == sorted(NAMES)
+    assert stats['ingest']['systems'] == len(NAMES)
+    # Systems loaded before the interruption weren't counted by this refresh, so the statistics come from the table.
+    assert stats['prefix_stats'] == 'rebuilt'
+    assert prefix_stats(refresh_bot) == pytest.approx(expected_stats(NAMES))
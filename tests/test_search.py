@@ -0,0 +1,94 @@
+"""
+Tests for ranking !search results.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import random
+
+import pytest
+
+from ratlib.db import get_session
+from ratlib.starsystem import search_names
+
+
+def systems_csv(names):
+    """Formats names as starsystem CSV data, numbering them from 1."""
+    return "id,name,x,y,z\n" + "".join("{0},{1},,,\n".format(eddb_id, name) for eddb_id, name in enumerate(names, 1))
+
+
+@pytest.fixture
+def indexed(refresh_bot, refresh, stand_in):
+    """
+    Returns a function that loads a list of names into the database and the bot's system store, and returns a function
+    that searches them like search_names().
+    """
+    def index(names):
+        refresh_bot.config.ratbot.system_store = True
+        stand_in.add('systems.csv', systems_csv(names))
+        refresh()
+
+        def search(name, **kwargs):
+            db = get_session(refresh_bot)
+            try:
+                return search_names(refresh_bot, name, db=db, **kwargs)
+            finally:
+                db.close()
+        return search
+    return index
+
+
+def levenshtein(a, b):
+    """Returns the Levenshtein distance between two strings."""
+    row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        previous, row[0] = row[0], i
+        for j, cb in enumerate(b, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (ca != cb))
+    return row[-1]
+
+
+def brute_force(names, name, max_distance=10, max_results=4):
+    """Returns the distances of the closest names to name, closest first."""
+    return sorted(d for d in (levenshtein(other.lower(), name) for other in names) if d <= max_distance)[:max_results]
+
+
+def test_closer_name_without_prefix(indexed):
+    search = indexed(["HIP 123456", "HIP 1235", "Eol Prou LW-L c8-306"])
+    assert search("hip 1234") == [("HIP 1235", 1), ("HIP 123456", 2)]
+
+
+def test_prefixes_only_bound_the_search(indexed):
+    # Plenty of names start with the search, but none closely enough to rule out the one that doesn't.
+    search = indexed(
+        ["Col 285 Sector AB", "Col 285 Sector CD", "Col 285 Sector EF", "Col 285 Sector GH", "Col 28 Sector"]
+    )
+    result = search("col 285 sector")
+    assert result[0] == ("Col 28 Sector", 1)
+    assert [distance for name, distance in result] == [1, 3, 3, 3]
+
+
+def test_close_prefixes_are_conclusive(indexed):
+    search = indexed(["Sol", "Sola", "Solb", "Solc", "Sal", "Sold"])
+    result = search("sol")
+    assert result[0] == ("Sol", 0)
+    assert [distance for name, distance in result] == [0, 1, 1, 1]
+    assert all(name.lower().startswith("sol") for name, distance in result)
+
+
+def test_matches_brute_force(indexed):
+    rng = random.Random(0)
+    names = list(set(
+        "{} {}{}".format(rng.choice(["HIP", "Col", "Wregoe", "Synuefe"]), rng.randint(1, 99), rng.choice(["", "0", "5"]))
+        for _ in range(300)
+    ))
+    search = indexed(names)
+    for name in rng.sample(names, 50) + ["hip 1", "col", "wregoe 5", "synuefe 12345"]:
+        name = name.lower()
+        assert [distance for _, distance in search(name)] == brute_force(names, name), name
@@ -0,0 +1,117 @@
+"""
+Tests for refreshing starsystems into shadow tables and swapping them in.
+
+These need a PostgreSQL database; see the refresh_bot fixture.
+
+Copyright (c) 2017 The Fuel Rats Mischief,
+All rights reserved.
+
+Licensed under the BSD 3-Clause License.
+
+See LICENSE.md
+"""
+import threading
+
+import pytest
+import sqlalchemy as sa
+
+import ratlib.starsystem
+from ratlib.db import get_session
+
+TABLES = ('starsystem', 'starsystem_prefix')
+
+
+def systems_csv(*names):
+    """Formats names as starsystem CSV data, numbering them from 1."""
+    return "id,name,x,y,z\n" + "".join(
+        "{0},{1},{0}.5,{0}.25,-{0}\n".format(eddb_id, name) for eddb_id, name in enumerate(names, 1)
+    )
+
+
+def schema(bot):
+    """
+    Returns what a swap has to preserve: the definitions of the starsystem tables' constraints and indexes by name, and
+    the names of any other tables they've left behind.
+    """
+    db = get_session(bot)
+    try:
+        constraints = dict(db.execute(sa.text("""
+            SELECT conname, conrelid::REGCLASS || ': ' || pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE conrelid::REGCLASS::TEXT = ANY(:tables)
+        """).bindparams(tables=list(TABLES))).fetchall())
+        indexes = dict(db.execute(sa.text("""
+            SELECT indexname, indexdef FROM pg_indexes WHERE tablename = ANY(:tables)
+        """).bindparams(tables=list(TABLES))).fetchall())
+        leftovers = sorted(row[0] for row in db.execute(
+            "SELECT relname FROM pg_class WHERE relname LIKE '%\\_\\_old' OR relname LIKE '%\\_\\_shadow'"
+        ))
+    finally:
+        db.close()
+    return constraints, indexes, leftovers
+
+
+def read_starsystems(bot):
+    """Returns a connection in the middle of a transaction that has read from the starsystem table."""
+    conn = get_session(bot).get_bind().connect()
+    conn.begin()
+    conn.execute("SELECT COUNT(*) FROM starsystem")
+    return conn
+
+
+def test_shadow_refresh(refresh_bot, refresh, stand_in):
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v1"')
+    refresh()
+    before = schema(refresh_bot)
+    assert before[2] == []
+
+    refresh_bot.config.ratbot.edsm_shadow_tables = True
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta Prime", "Gamma"), etag='"v2"')
+    stats, status, names = refresh()
+    assert names == ["Alpha", "Beta Prime", "Gamma"]
+    assert stats['changes'] == {'added': 1, 'updated': 1, 'unchanged': 1}
+    assert stats['swap'] is not None
+    # Same constraints and indexes under the same names, and nothing left over.
+    assert schema(refresh_bot) == before
+
+
+def test_swap_waits_for_readers(refresh_bot, refresh, stand_in, monkeypatch, capsys):
+    monkeypatch.setattr(ratlib.starsystem, 'SWAP_LOCK_TIMEOUT', 0.2)
+    monkeypatch.setattr(ratlib.starsystem, 'SWAP_ATTEMPTS', 10)
+    stand_in.add('systems.csv', systems_csv("Alpha"), etag='"v1"')
+    refresh()
+    refresh_bot.config.ratbot.edsm_shadow_tables = True
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v2"')
+
+    # A long-running query holds the live table until a little after the swap has started waiting for it.
+    reader = read_starsystems(refresh_bot)
+    timer = threading.Timer(0.5, reader.close)
+    timer.start()
+    try:
+        stats, status, names = refresh()
+    finally:
+        timer.join()
+    assert names == ["Alpha", "Beta"]
+    assert "Live starsystem tables are busy" in capsys.readouterr().out
+    # The wait doesn't count, since the tables were only locked once it was over.
+    assert stats['swap'] < 0.5
+
+
+def test_swap_gives_up(refresh_bot, refresh, stand_in, monkeypatch):
+    monkeypatch.setattr(ratlib.starsystem, 'SWAP_LOCK_TIMEOUT', 0.1)
+    monkeypatch.setattr(ratlib.starsystem, 'SWAP_ATTEMPTS', 2)
+    stand_in.add('systems.csv', systems_csv("Alpha"), etag='"v1"')
+    refresh()
+    before = schema(refresh_bot)
+    refresh_bot.config.ratbot.edsm_shadow_tables = True
+    stand_in.add('systems.csv', systems_csv("Alpha", "Beta"), etag='"v2"')
+
+    reader = read_starsystems(refresh_bot)
+    try:
+        with pytest.raises(sa.exc.OperationalError):
+            refresh()
+    finally:
+        reader.close()
+    # The live tables are untouched, and the shadow tables went away with the transaction.
+    assert schema(refresh_bot) == before
+    stats, status, names = refresh()
+    assert names == ["Alpha", "Beta"]